@@ -3,16 +3,41 @@ import logging
 import datetime
 import uuid
 import json
+import base64
 import urllib.request
 import PyPDF2
 import urllib.parse
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import sys
+import threading
+import time
+import unicodedata
+import re
+import hashlib
+import tempfile
+import atexit
+import shutil
+import shlex
+import subprocess
+import contextlib
+import functools
+import multiprocessing
+import socket
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, Response, has_request_context, abort, g
+from flask.cli import AppGroup
+import click
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.wsgi import wrap_file
 from werkzeug.middleware.proxy_fix import ProxyFix
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event, text, table, column, literal_column, func, select, union_all, insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase, make_transient_to_detached
+from markupsafe import Markup, escape
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -184,8 +209,94 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 # File upload configuration
-app.config['UPLOAD_FOLDER'] = 'static/repositorio/documents/'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+# Uploaded file storage: 'local' (under static/) or 's3' (any S3-compatible endpoint, e.g. MinIO)
+app.config['ALMACENAMIENTO'] = os.environ.get("ALMACENAMIENTO", "local")
+app.config['S3_BUCKET'] = os.environ.get("S3_BUCKET")
+app.config['S3_PREFIJO'] = os.environ.get("S3_PREFIJO", "")
+app.config['S3_ENDPOINT_URL'] = os.environ.get("S3_ENDPOINT_URL")  # e.g. http://localhost:9000
+app.config['S3_REGION'] = os.environ.get("S3_REGION")
+app.config['S3_URL_EXPIRACION_SEGUNDOS'] = 300
+# Storage keys for repository PDFs and class videos
+app.config['DOCUMENTOS_PREFIJO'] = 'repositorio/documents/'
+app.config['VIDEOS_PREFIJO'] = 'uploads/'
+# Video streaming: browser cache lifetime for versioned video URLs and optional nginx
+# offload (internal location aliased to the static/ folder, e.g. /protected/static/)
+app.config['VIDEOS_CACHE_SEGUNDOS'] = 365 * 24 * 60 * 60
+app.config['STATIC_X_ACCEL_PREFIX'] = os.environ.get("STATIC_X_ACCEL_PREFIX")
+# Repository PDF delivery: browser cache lifetime for content-versioned download URLs
+# (unversioned ones are revalidated on every request) and optional web-server offload
+app.config['REPOSITORIO_CACHE_SEGUNDOS'] = 30 * 24 * 60 * 60
+app.config['REPOSITORIO_X_ACCEL_PREFIX'] = os.environ.get("REPOSITORIO_X_ACCEL_PREFIX")  # e.g. /protected/repositorio/
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE") == "1"
+# Repository listing page size
+app.config['REPOSITORIO_POR_PAGINA'] = 24
+app.config['REPOSITORIO_MAX_POR_PAGINA'] = 100
+# Classroom catalogue: videos shown per subject on the overview and page size inside one subject
+app.config['CLASSROOM_VIDEOS_POR_MATERIA'] = 6
+app.config['CLASSROOM_POR_PAGINA'] = 24
+# Repository facet summary is recomputed at most this often per process
+app.config['FACETAS_TTL_SEGUNDOS'] = 60
+# Download counters are flushed to the database this often per process
+app.config['DESCARGAS_INTERVALO_SEGUNDOS'] = 5
+# Uploads are copied to disk and hashed in blocks of this size
+app.config['BLOQUE_SUBIDA_BYTES'] = 1024 * 1024
+# PDF text is indexed in chunks of roughly this many characters
+app.config['FRAGMENTO_TEXTO_CARACTERES'] = 1000
+# Resumable video uploads: chunk size, maximum video size, where partial files live
+# and how long an untouched upload session is kept before the sweep removes it
+app.config['VIDEO_BLOQUE_BYTES'] = 8 * 1024 * 1024
+app.config['VIDEO_MAX_BYTES'] = 4 * 1024 * 1024 * 1024
+app.config['SUBIDAS_DIRECTORIO'] = os.path.join(app.instance_path, 'subidas')
+app.config['SUBIDAS_RETENCION_HORAS'] = 24
+# Background job queue: retries with exponential backoff, how long a worker may hold a job
+# before another one takes it over and polling interval. Jobs run in `flask tareas trabajar`
+# worker processes; TAREAS_TRABAJADOR_INTERNO=1 also runs them in a thread of each web
+# process, for development only (thumbnails and transcodes would compete with requests)
+app.config['TAREAS_MAX_INTENTOS'] = 5
+app.config['TAREAS_BACKOFF_SEGUNDOS'] = 30
+app.config['TAREAS_BLOQUEO_SEGUNDOS'] = 10 * 60
+app.config['TAREAS_INTERVALO_SEGUNDOS'] = 2
+app.config['TAREAS_TRABAJADOR_INTERNO'] = os.environ.get("TAREAS_TRABAJADOR_INTERNO") == "1"
+# Jobs enqueued after each upload, in order
+app.config['TAREAS_DOCUMENTO'] = ['escaneo_virus', 'metadatos_pdf', 'miniatura_pdf', 'indexar_texto']
+app.config['TAREAS_VIDEO'] = ['escaneo_virus', 'procesar_video']
+# Optional HLS packaging of uploaded class videos with a local ffmpeg (HLS_ACTIVO=1).
+# Renditions are (height, video kbps, audio kbps); taller ones than the source are skipped.
+app.config['HLS_ACTIVO'] = os.environ.get("HLS_ACTIVO") == "1"
+app.config['HLS_VARIANTES'] = [(360, 800, 96), (540, 1400, 128), (720, 2800, 128)]
+app.config['HLS_SEGUNDOS_SEGMENTO'] = 6
+app.config['HLS_PREFIJO'] = 'hls/'
+app.config['HLS_CACHE_SEGUNDOS'] = 365 * 24 * 60 * 60
+app.config['FFMPEG_BINARIO'] = os.environ.get("FFMPEG_BINARIO", "ffmpeg")
+app.config['FFPROBE_BINARIO'] = os.environ.get("FFPROBE_BINARIO", "ffprobe")
+# Video processing (faststart remux, poster frame, real duration): poster width and the
+# static videos handled by `flask videos procesar-estaticos`
+app.config['POSTER_ANCHO_MAX'] = 1280
+app.config['POSTERS_PREFIJO'] = 'posters/'
+app.config['VIDEOS_ESTATICOS_DIRECTORIO'] = os.path.join('recursos de plantillas', 'uniforme', 'videos')  # under static/
+# Optional virus scanner run on every upload; the file path is appended (exit 0 = clean, 1 = infected)
+app.config['ESCANER_VIRUS_COMANDO'] = os.environ.get("ESCANER_VIRUS_COMANDO")  # e.g. clamdscan --no-summary --fdpass
+# First-page PDF thumbnails: WebP widths, storage key prefix, browser cache lifetime and the
+# poppler renderer (thumbnails are skipped when pdftoppm or Pillow are not installed)
+app.config['MINIATURAS_ANCHOS'] = [160, 320, 640]
+app.config['MINIATURAS_PREFIJO'] = 'miniaturas/'
+app.config['MINIATURAS_CACHE_SEGUNDOS'] = 365 * 24 * 60 * 60
+app.config['PDFTOPPM_BINARIO'] = os.environ.get("PDFTOPPM_BINARIO", "pdftoppm")
+# PDF metadata cache limits (per process)
+app.config['PDF_CACHE_MAX_ENTRIES'] = int(os.environ.get("PDF_CACHE_MAX_ENTRIES", 1024))
+app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get("PDF_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+# Logged-in user identity cache (per process): lifetime of an entry and maximum entries.
+# Changes made in another process become visible after at most this many seconds.
+app.config['USUARIOS_CACHE_SEGUNDOS'] = int(os.environ.get("USUARIOS_CACHE_SEGUNDOS", 30))
+app.config['USUARIOS_CACHE_MAX_ENTRIES'] = int(os.environ.get("USUARIOS_CACHE_MAX_ENTRIES", 4096))
+# Password hashing policy: 'scrypt' (work factor = N) or 'pbkdf2' (work factor = iterations).
+# Hashes made with another setting are upgraded the next time the user logs in.
+app.config['PASSWORD_ALGORITMO'] = os.environ.get("PASSWORD_ALGORITMO", "scrypt")
+app.config['PASSWORD_FACTOR_TRABAJO'] = int(os.environ.get("PASSWORD_FACTOR_TRABAJO", 0)) or None
+# Report SQL statements executed and saved by request-scoped memoization in the
+# X-Consultas-SQL / X-Consultas-Ahorradas response headers and the debug log
+app.config['CONSULTAS_POR_SOLICITUD'] = os.environ.get("CONSULTAS_POR_SOLICITUD") == "1"
 
 # Initialize database
 
@@ -214,6 +325,12 @@ class Estudiante(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     fecha_registro = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     activo = db.Column(db.Boolean, default=True)
+
+    user_type = 'estudiante'
+    
+    def get_id(self):
+        # Identificador con tipo: estudiantes y profesores comparten el rango de ids
+        return f'e:{self.id}'
     
     def get_nombre_completo(self):
         return f'{self.nombre} {self.apellido}'
@@ -234,6 +351,12 @@ class Profesor(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     fecha_registro = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     activo = db.Column(db.Boolean, default=True)
+    nombre_normalizado = db.Column(db.String(250), index=True)  # minúsculas, sin acentos, palabras ordenadas
+
+    user_type = 'profesor'
+    
+    def get_id(self):
+        return f'p:{self.id}'
     
     def get_nombre_completo(self):
         return f'{self.nombre} {self.apellido}'
@@ -280,9 +403,16 @@ class VideoClase(db.Model):
     duracion_minutos = db.Column(db.Integer)
     fecha_subida = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     activo = db.Column(db.Boolean, default=True)
+    sha256 = db.Column(db.String(64), index=True)  # hash del contenido de archivo_video
+    hls_playlist = db.Column(db.String(500))  # clave de la lista maestra HLS, si ya se empaquetó
+    poster = db.Column(db.String(500))  # clave de la imagen de portada del video
     
     profesor = db.relationship('Profesor', backref='videos_subidos')
 
+    __table_args__ = (
+        db.Index('ix_videos_clases_catalogo', 'activo', 'materia', 'fecha_subida', 'id'),
+    )
+
 class TokenQRProfesor(db.Model):
     __tablename__ = 'tokens_qr_profesores'
     
@@ -313,37 +443,702 @@ class DocumentoRepositorio(db.Model):
     descargas = db.Column(db.Integer, default=0)
     activo = db.Column(db.Boolean, default=True)
     palabras_clave = db.Column(db.Text)  # separadas por comas
+    sha256 = db.Column(db.String(64), index=True)  # hash del contenido de archivo_pdf
+    miniatura_sha256 = db.Column(db.String(64))  # hash del PDF del que se generó la portada
     
     autor = db.relationship('Profesor', backref='documentos_repositorio')
 
+    __table_args__ = (
+        db.Index('ix_documentos_repositorio_listado', 'activo', 'fecha_subida', 'id'),
+    )
+
+class EventoDescarga(db.Model):
+    __tablename__ = 'eventos_descarga'
+
+    id = db.Column(db.Integer, primary_key=True)
+    documento_id = db.Column(db.Integer, db.ForeignKey('documentos_repositorio.id'), nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+
+class DescargaDiaria(db.Model):
+    __tablename__ = 'descargas_diarias'
+
+    documento_id = db.Column(db.Integer, db.ForeignKey('documentos_repositorio.id'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    cantidad = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_descargas_diarias_fecha', 'fecha', 'documento_id'),
+    )
+
+class Consolidacion(db.Model):
+    __tablename__ = 'consolidaciones'
+
+    nombre = db.Column(db.String(50), primary_key=True)
+    ultimo_dia = db.Column(db.Date, nullable=False)  # último día completo ya consolidado
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class Contador(db.Model):
+    __tablename__ = 'contadores'
+
+    nombre = db.Column(db.String(50), primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+
+class MetadatosDocumento(db.Model):
+    __tablename__ = 'metadatos_documentos'
+
+    id = db.Column(db.Integer, primary_key=True)
+    documento_id = db.Column(db.Integer, db.ForeignKey('documentos_repositorio.id'), unique=True, nullable=False)
+    titulo = db.Column(db.String(500))
+    autor = db.Column(db.String(500))
+    num_paginas = db.Column(db.Integer)
+    productor = db.Column(db.String(500))
+    asunto = db.Column(db.String(500))
+    creado = db.Column(db.DateTime)
+    fecha_extraccion = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    documento = db.relationship('DocumentoRepositorio', backref=db.backref('metadatos', uselist=False))
+
+class FragmentoTextoDocumento(db.Model):
+    __tablename__ = 'fragmentos_texto_documentos'
+
+    id = db.Column(db.Integer, primary_key=True)
+    documento_id = db.Column(db.Integer, db.ForeignKey('documentos_repositorio.id'), nullable=False, index=True)
+    numero = db.Column(db.Integer, nullable=False)
+    pagina = db.Column(db.Integer)
+    texto = db.Column(db.Text, nullable=False)
+
+    documento = db.relationship('DocumentoRepositorio', backref='fragmentos_texto')
+
+class SesionSubida(db.Model):
+    __tablename__ = 'sesiones_subida'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    profesor_id = db.Column(db.Integer, db.ForeignKey('profesores.id'), nullable=False)
+    nombre_archivo = db.Column(db.String(255), nullable=False)
+    tamano = db.Column(db.BigInteger, nullable=False)
+    tamano_bloque = db.Column(db.Integer, nullable=False)
+    tipo_contenido = db.Column(db.String(100))
+    sha256 = db.Column(db.String(64))  # hash del archivo completo declarado por el cliente (opcional)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+
+    bloques = db.relationship('BloqueSubida', backref='sesion', cascade='all, delete-orphan')
+
+    @property
+    def total_bloques(self):
+        return max(-(-self.tamano // self.tamano_bloque), 1)
+
+class BloqueSubida(db.Model):
+    __tablename__ = 'bloques_subida'
+
+    sesion_id = db.Column(db.String(32), db.ForeignKey('sesiones_subida.id'), primary_key=True)
+    indice = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+
+class Tarea(db.Model):
+    __tablename__ = 'tareas'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    entidad = db.Column(db.String(30), nullable=False)  # 'documento' o 'video'
+    entidad_id = db.Column(db.Integer, nullable=False)
+    argumentos = db.Column(db.Text)  # JSON
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, en_proceso, completada, fallida
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=5)
+    error = db.Column(db.Text)
+    trabajador = db.Column(db.String(100))
+    ejecutar_desde = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    bloqueada_hasta = db.Column(db.DateTime)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    fecha_fin = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_tareas_disponibles', 'estado', 'ejecutar_desde'),
+        db.Index('ix_tareas_entidad', 'entidad', 'entidad_id'),
+    )
+
+MODELOS_USUARIO = {'e': Estudiante, 'p': Profesor}
+
+class CacheIdentidades:
+    """
+    Caché LRU con vencimiento de las columnas de los usuarios autenticados, por identificador con tipo
+    """
+    def __init__(self, max_entradas, ttl_segundos):
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self._entradas = OrderedDict()  # 'p:7' -> (expira, valores de las columnas)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, identidad):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(identidad)
+            if entrada is None or entrada[0] <= ahora:
+                self._entradas.pop(identidad, None)
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(identidad)
+            self.aciertos += 1
+            return entrada[1]
+
+    def guardar(self, identidad, valores):
+        if self.ttl_segundos <= 0:
+            return
+        with self._lock:
+            self._entradas.pop(identidad, None)
+            self._entradas[identidad] = (time.monotonic() + self.ttl_segundos, valores)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def invalidar(self, identidad):
+        with self._lock:
+            self._entradas.pop(identidad, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos
+            }
+
+cache_identidades = CacheIdentidades(app.config['USUARIOS_CACHE_MAX_ENTRIES'], app.config['USUARIOS_CACHE_SEGUNDOS'])
+
+def valores_usuario(user):
+    return {atributo.key: getattr(user, atributo.key) for atributo in db.inspect(type(user)).column_attrs}
+
+def usuario_desde_cache(modelo, valores):
+    # Reconstruye la instancia como si viniera de la base de datos y la asocia a la sesión
+    # sin consultar; las relaciones se siguen cargando de forma perezosa al usarlas
+    user = modelo(**valores)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
 # User loader for login manager
 @login_manager.user_loader
 def load_user(user_id):
-    user = Estudiante.query.get(user_id)
-    if user:
-        user.user_type = 'estudiante'
-        return user
-    
-    user = Profesor.query.get(user_id)
+    tipo, _, valor = user_id.partition(':')
+    modelo = MODELOS_USUARIO.get(tipo)
+    if modelo is None or not valor.isdigit():
+        # Sesiones anteriores guardaban solo el número, que no distingue estudiante de profesor
+        return None
+
+    valores = cache_identidades.obtener(user_id)
+    if valores is not None:
+        return usuario_desde_cache(modelo, valores)
+
+    user = db.session.get(modelo, int(valor))
     if user:
-        user.user_type = 'profesor'
-        return user
-    
-    return None
+        cache_identidades.guardar(user_id, valores_usuario(user))
+    return user
+
+FACTORES_TRABAJO_PREDETERMINADOS = {'scrypt': 2 ** 15, 'pbkdf2': 1000000}
+
+def metodo_hash_contrasena():
+    # Método en el formato de werkzeug, que es también el prefijo guardado en cada hash
+    algoritmo = app.config['PASSWORD_ALGORITMO']
+    if algoritmo not in FACTORES_TRABAJO_PREDETERMINADOS:
+        raise ValueError(f"Algoritmo de contraseñas no soportado: {algoritmo}")
+    factor = app.config['PASSWORD_FACTOR_TRABAJO'] or FACTORES_TRABAJO_PREDETERMINADOS[algoritmo]
+    if algoritmo == 'scrypt':
+        return f"scrypt:{factor}:8:1"
+    return f"pbkdf2:sha256:{factor}"
+
+def cifrar_contrasena(password):
+    return generate_password_hash(password, method=metodo_hash_contrasena())
+
+def hash_desactualizado(password_hash):
+    return password_hash.split('$', 1)[0] != metodo_hash_contrasena()
+
+@event.listens_for(Estudiante, 'after_update')
+@event.listens_for(Estudiante, 'after_delete')
+@event.listens_for(Profesor, 'after_update')
+@event.listens_for(Profesor, 'after_delete')
+def _invalidar_identidad(mapper, connection, target):
+    cache_identidades.invalidar(target.get_id())
+
+def normalizar_texto(texto):
+    # Minúsculas y sin acentos, para indexar y consultar de la misma forma
+    texto = unicodedata.normalize('NFKD', texto or '')
+    return ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+
+def normalizar_nombre(nombre, apellido=''):
+    # 'Pérez  Juan' y 'juan perez' producen la misma clave: 'juan perez'
+    palabras = re.findall(r'\w+', normalizar_texto(f"{nombre or ''} {apellido or ''}"))
+    return ' '.join(sorted(palabras))
+
+@event.listens_for(Profesor, 'before_insert')
+@event.listens_for(Profesor, 'before_update')
+def _normalizar_nombre_profesor(mapper, connection, target):
+    target.nombre_normalizado = normalizar_nombre(target.nombre, target.apellido)
+
+# Columnas agregadas a tablas que ya existían: (tabla, columna, tipo SQL)
+COLUMNAS_NUEVAS = [
+    ('profesores', 'nombre_normalizado', 'VARCHAR(250)'),
+    ('documentos_repositorio', 'sha256', 'VARCHAR(64)'),
+    ('videos_clases', 'sha256', 'VARCHAR(64)'),
+    ('documentos_repositorio', 'miniatura_sha256', 'VARCHAR(64)'),
+    ('videos_clases', 'hls_playlist', 'VARCHAR(500)'),
+    ('videos_clases', 'poster', 'VARCHAR(500)'),
+]
+
+def actualizar_esquema():
+    # create_all no modifica tablas existentes: agrega aquí las columnas nuevas. Sus índices,
+    # si el modelo los declara, se crean abajo junto con el resto de índices de los modelos.
+    inspector = db.inspect(db.engine)
+    agregadas = set()
+    for tabla, columna, tipo in COLUMNAS_NUEVAS:
+        if columna in {c['name'] for c in inspector.get_columns(tabla)}:
+            continue
+        with db.engine.begin() as conexion:
+            conexion.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}"))
+        agregadas.add((tabla, columna))
+
+    # Versiones anteriores indexaban todas las columnas nuevas: se quitan los que el modelo no declara
+    for tabla, columna, _ in COLUMNAS_NUEVAS:
+        nombre = f"ix_{tabla}_{columna}"
+        if nombre not in {indice.name for indice in db.metadata.tables[tabla].indexes}:
+            with db.engine.begin() as conexion:
+                conexion.execute(text(f"DROP INDEX IF EXISTS {nombre}"))
+
+    # create_all tampoco crea los índices compuestos declarados después en tablas que ya existían
+    for tabla in db.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        for indice in tabla.indexes:
+            indice.create(db.engine, checkfirst=True)
+
+    if ('profesores', 'nombre_normalizado') in agregadas:
+        with db.engine.begin() as conexion:
+            filas = conexion.execute(text("SELECT id, nombre, apellido FROM profesores")).all()
+            if filas:
+                conexion.execute(
+                    text("UPDATE profesores SET nombre_normalizado = :clave WHERE id = :id"),
+                    [{'id': profesor_id, 'clave': normalizar_nombre(nombre, apellido)}
+                     for profesor_id, nombre, apellido in filas]
+                )
+
+# Búsqueda de texto completo del repositorio
+# SQLite usa una tabla virtual FTS5 (unicode61 elimina los acentos); PostgreSQL una tabla con
+# tsvector en configuración 'spanish' e índice GIN. Ambas se mantienen con eventos del modelo.
+TABLA_BUSQUEDA = 'busqueda_documentos'
+TABLA_FRAGMENTOS = 'busqueda_fragmentos'
+PESO_CONTENIDO = 0.5  # las coincidencias en el texto del PDF pesan menos que en título o palabras clave
+MARCA_INICIO, MARCA_FIN = '\x02', '\x03'
+SUFIJOS_ESPANOL = sorted([
+    'aciones', 'amientos', 'imientos', 'amiento', 'imiento', 'acion', 'adoras', 'adores',
+    'adora', 'ador', 'ancias', 'ancia', 'encias', 'encia', 'idades', 'idad', 'mente',
+    'ables', 'ibles', 'able', 'ible', 'istas', 'ista', 'osos', 'osas', 'oso', 'osa',
+    'ivos', 'ivas', 'ivo', 'iva', 'ando', 'iendo', 'ados', 'adas', 'idos', 'idas',
+    'ado', 'ada', 'ido', 'ida', 'ar', 'er', 'ir', 'es', 'as', 'os', 'a', 'o', 'e', 's'
+], key=len, reverse=True)
+
+def raiz_espanol(palabra):
+    # Stemming ligero: quita el sufijo más largo conservando una raíz de al menos 3 letras
+    for sufijo in SUFIJOS_ESPANOL:
+        if palabra.endswith(sufijo) and len(palabra) - len(sufijo) >= 3:
+            return palabra[:-len(sufijo)]
+    return palabra
+
+def terminos_busqueda(buscar):
+    return re.findall(r'\w+', normalizar_texto(buscar))
+
+def busqueda_dialecto():
+    return db.engine.dialect.name if app.config.get('BUSQUEDA_TEXTO_COMPLETO') else None
+
+def inicializar_indice_busqueda():
+    dialecto = db.engine.dialect.name
+    try:
+        with db.engine.begin() as conexion:
+            if dialecto == 'sqlite':
+                conexion.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLA_BUSQUEDA} USING fts5("
+                    "titulo, descripcion, palabras_clave, tokenize='unicode61 remove_diacritics 2')"
+                ))
+                # Índice de contenido externo: el texto vive solo en fragmentos_texto_documentos
+                conexion.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLA_FRAGMENTOS} USING fts5("
+                    "texto, content='fragmentos_texto_documentos', content_rowid='id', "
+                    "tokenize='unicode61 remove_diacritics 2')"
+                ))
+            elif dialecto == 'postgresql':
+                conexion.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {TABLA_BUSQUEDA} ("
+                    "documento_id INTEGER PRIMARY KEY REFERENCES documentos_repositorio(id) ON DELETE CASCADE, "
+                    "vector TSVECTOR NOT NULL)"
+                ))
+                conexion.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{TABLA_BUSQUEDA}_vector ON {TABLA_BUSQUEDA} USING GIN (vector)"
+                ))
+                conexion.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {TABLA_FRAGMENTOS} ("
+                    "fragmento_id INTEGER PRIMARY KEY REFERENCES fragmentos_texto_documentos(id) ON DELETE CASCADE, "
+                    "vector TSVECTOR NOT NULL)"
+                ))
+                conexion.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{TABLA_FRAGMENTOS}_vector ON {TABLA_FRAGMENTOS} USING GIN (vector)"
+                ))
+            else:
+                app.config['BUSQUEDA_TEXTO_COMPLETO'] = False
+                return
+        app.config['BUSQUEDA_TEXTO_COMPLETO'] = True
+    except Exception as e:
+        logging.warning(f"Búsqueda de texto completo no disponible, se usará LIKE: {e}")
+        app.config['BUSQUEDA_TEXTO_COMPLETO'] = False
+        return
+
+    # Primera ejecución sobre una base existente: poblar el índice
+    with db.engine.connect() as conexion:
+        indexados = conexion.execute(text(f"SELECT COUNT(*) FROM {TABLA_BUSQUEDA}")).scalar()
+        documentos = conexion.execute(text("SELECT COUNT(*) FROM documentos_repositorio")).scalar()
+    if documentos and not indexados:
+        reindexar_busqueda()
+
+def indexar_documento(conexion, documento_id, titulo, descripcion, palabras_clave):
+    dialecto = busqueda_dialecto()
+    if dialecto == 'sqlite':
+        conexion.execute(text(f"DELETE FROM {TABLA_BUSQUEDA} WHERE rowid = :id"), {'id': documento_id})
+        conexion.execute(
+            text(f"INSERT INTO {TABLA_BUSQUEDA} (rowid, titulo, descripcion, palabras_clave) "
+                 "VALUES (:id, :titulo, :descripcion, :palabras_clave)"),
+            {'id': documento_id, 'titulo': titulo or '', 'descripcion': descripcion or '',
+             'palabras_clave': palabras_clave or ''}
+        )
+    elif dialecto == 'postgresql':
+        conexion.execute(
+            text(f"INSERT INTO {TABLA_BUSQUEDA} (documento_id, vector) VALUES (:id, "
+                 "setweight(to_tsvector('spanish', :titulo), 'A') || "
+                 "setweight(to_tsvector('spanish', :palabras_clave), 'B') || "
+                 "setweight(to_tsvector('spanish', :descripcion), 'C')) "
+                 "ON CONFLICT (documento_id) DO UPDATE SET vector = EXCLUDED.vector"),
+            {'id': documento_id, 'titulo': normalizar_texto(titulo),
+             'descripcion': normalizar_texto(descripcion),
+             'palabras_clave': normalizar_texto(palabras_clave)}
+        )
+
+def desindexar_documento(conexion, documento_id):
+    dialecto = busqueda_dialecto()
+    if dialecto == 'sqlite':
+        conexion.execute(text(f"DELETE FROM {TABLA_BUSQUEDA} WHERE rowid = :id"), {'id': documento_id})
+    elif dialecto == 'postgresql':
+        conexion.execute(text(f"DELETE FROM {TABLA_BUSQUEDA} WHERE documento_id = :id"), {'id': documento_id})
+
+def indexar_fragmentos(conexion, fragmentos):
+    dialecto = busqueda_dialecto()
+    if not fragmentos:
+        return
+    if dialecto == 'sqlite':
+        conexion.execute(
+            text(f"INSERT INTO {TABLA_FRAGMENTOS} (rowid, texto) VALUES (:id, :texto)"),
+            [{'id': f.id, 'texto': f.texto} for f in fragmentos]
+        )
+    elif dialecto == 'postgresql':
+        conexion.execute(
+            text(f"INSERT INTO {TABLA_FRAGMENTOS} (fragmento_id, vector) VALUES (:id, to_tsvector('spanish', :texto)) "
+                 "ON CONFLICT (fragmento_id) DO UPDATE SET vector = EXCLUDED.vector"),
+            [{'id': f.id, 'texto': normalizar_texto(f.texto)} for f in fragmentos]
+        )
+
+def desindexar_fragmentos(conexion, documento_id):
+    dialecto = busqueda_dialecto()
+    if dialecto == 'sqlite':
+        # Con contenido externo, FTS5 necesita los valores anteriores para borrar las entradas
+        conexion.execute(
+            text(f"INSERT INTO {TABLA_FRAGMENTOS} ({TABLA_FRAGMENTOS}, rowid, texto) "
+                 "SELECT 'delete', id, texto FROM fragmentos_texto_documentos WHERE documento_id = :id"),
+            {'id': documento_id}
+        )
+    elif dialecto == 'postgresql':
+        conexion.execute(
+            text(f"DELETE FROM {TABLA_FRAGMENTOS} WHERE fragmento_id IN "
+                 "(SELECT id FROM fragmentos_texto_documentos WHERE documento_id = :id)"),
+            {'id': documento_id}
+        )
+
+def reindexar_busqueda():
+    dialecto = busqueda_dialecto()
+    if not dialecto:
+        return 0
+    with db.engine.begin() as conexion:
+        conexion.execute(text(f"DELETE FROM {TABLA_BUSQUEDA}"))
+        filas = conexion.execute(text(
+            "SELECT id, titulo, descripcion, palabras_clave FROM documentos_repositorio"
+        )).all()
+        for fila in filas:
+            indexar_documento(conexion, *fila)
+        if dialecto == 'sqlite':
+            conexion.execute(text(f"INSERT INTO {TABLA_FRAGMENTOS} ({TABLA_FRAGMENTOS}) VALUES ('rebuild')"))
+        else:
+            conexion.execute(text(f"DELETE FROM {TABLA_FRAGMENTOS}"))
+            indexar_fragmentos(conexion, FragmentoTextoDocumento.query.all())
+    return len(filas)
+
+@event.listens_for(DocumentoRepositorio, 'after_insert')
+@event.listens_for(DocumentoRepositorio, 'after_update')
+def _indexar_documento_repositorio(mapper, connection, target):
+    indexar_documento(connection, target.id, target.titulo, target.descripcion, target.palabras_clave)
+
+@event.listens_for(DocumentoRepositorio, 'after_delete')
+def _desindexar_documento_repositorio(mapper, connection, target):
+    desindexar_documento(connection, target.id)
+
+def resaltar_fragmento(fragmento):
+    # Escapa el texto del documento y solo convierte las marcas del motor de búsqueda en <mark>
+    if not fragmento:
+        return None
+    texto = str(escape(fragmento))
+    return Markup(texto.replace(MARCA_INICIO, '<mark>').replace(MARCA_FIN, '</mark>'))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _contar_consulta_solicitud(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g._consultas_sql = g.get('_consultas_sql', 0) + 1
+
+def memo_solicitud(funcion):
+    """
+    Memoriza el resultado de una consulta durante la solicitud actual, por argumentos.
+    Cada acierto suma a g._consultas_ahorradas las sentencias que costó calcularlo.
+    """
+    @functools.wraps(funcion)
+    def envoltura(*args):
+        if not has_request_context():
+            return funcion(*args)
+        memo = g.setdefault('_memo_solicitud', {})
+        clave = (funcion.__name__,) + args
+        if clave in memo:
+            resultado, costo = memo[clave]
+            g._consultas_ahorradas = g.get('_consultas_ahorradas', 0) + costo
+            return resultado
+        antes = g.get('_consultas_sql', 0)
+        resultado = funcion(*args)
+        memo[clave] = (resultado, g.get('_consultas_sql', 0) - antes)
+        return resultado
+
+    def invalidar(*args):
+        if has_request_context():
+            g.get('_memo_solicitud', {}).pop((funcion.__name__,) + args, None)
+
+    def recordar(resultado, *args):
+        if has_request_context():
+            g.setdefault('_memo_solicitud', {})[(funcion.__name__,) + args] = (resultado, 1)
+
+    envoltura.invalidar = invalidar
+    envoltura.recordar = recordar
+    return envoltura
+
+@app.after_request
+def informar_consultas_solicitud(respuesta):
+    if app.config['CONSULTAS_POR_SOLICITUD']:
+        ejecutadas = g.get('_consultas_sql', 0)
+        ahorradas = g.get('_consultas_ahorradas', 0)
+        respuesta.headers['X-Consultas-SQL'] = str(ejecutadas)
+        respuesta.headers['X-Consultas-Ahorradas'] = str(ahorradas)
+        logging.debug(f"{request.method} {request.path}: {ejecutadas} consultas SQL, {ahorradas} ahorradas")
+    return respuesta
+
+class AlmacenamientoLocal:
+    """
+    Guarda los archivos subidos en el disco local, bajo static/
+    """
+    def __init__(self, raiz):
+        self.raiz = raiz
+        # Los temporales se crean en el mismo sistema de archivos para que os.replace sea atómico
+        self.directorio_temporal = raiz
+
+    def ruta(self, clave):
+        return os.path.join(self.raiz, *clave.split('/'))
+
+    def existe(self, clave):
+        return os.path.exists(self.ruta(clave))
+
+    def info(self, clave):
+        # (tamaño, versión) o None si no existe; la versión cambia cuando cambia el archivo
+        try:
+            stat = os.stat(self.ruta(clave))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def guardar(self, clave, temporal, tipo=None):
+        ruta_final = self.ruta(clave)
+        os.makedirs(os.path.dirname(ruta_final), exist_ok=True)
+        if os.path.exists(ruta_final):
+            os.remove(temporal)
+        else:
+            # shutil.move renombra si el temporal está en el mismo disco y si no, copia
+            shutil.move(temporal, ruta_final)
 
-# Create upload directory if it doesn't exist
-upload_dir = os.path.join(app.root_path, 'static', 'uploads')
-os.makedirs(upload_dir, exist_ok=True)
+    def abrir(self, clave):
+        return open(self.ruta(clave), 'rb')
+
+    def eliminar(self, clave):
+        if self.existe(clave):
+            os.remove(self.ruta(clave))
+
+    def url_descarga(self, clave, nombre_descarga=None, tipo=None):
+        # En disco local el archivo lo entrega la propia aplicación
+        return None
+
+class AlmacenamientoS3:
+    """
+    Guarda los archivos subidos en un bucket compatible con S3 (AWS, MinIO, etc.)
+    """
+    def __init__(self, bucket, prefijo='', endpoint_url=None, region=None, expiracion=300):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("ALMACENAMIENTO=s3 requiere el paquete boto3 (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("ALMACENAMIENTO=s3 requiere S3_BUCKET")
+        # Las credenciales se leen de las variables estándar AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+        self.cliente = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.bucket = bucket
+        self.prefijo = prefijo.strip('/') + '/' if prefijo.strip('/') else ''
+        self.expiracion = expiracion
+        self.directorio_temporal = None
+
+    def _clave(self, clave):
+        return self.prefijo + clave
+
+    def info(self, clave):
+        from botocore.exceptions import ClientError
+        try:
+            cabecera = self.cliente.head_object(Bucket=self.bucket, Key=self._clave(clave))
+        except ClientError:
+            return None
+        return cabecera['ContentLength'], cabecera['ETag']
+
+    def existe(self, clave):
+        return self.info(clave) is not None
+
+    def guardar(self, clave, temporal, tipo=None):
+        try:
+            if not self.existe(clave):
+                extra = {'ContentType': tipo} if tipo else None
+                self.cliente.upload_file(temporal, self.bucket, self._clave(clave), ExtraArgs=extra)
+        finally:
+            os.remove(temporal)
+
+    def abrir(self, clave):
+        # PyPDF2 necesita un archivo con seek: se descarga a un temporal que queda en memoria si es pequeño
+        archivo = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        try:
+            self.cliente.download_fileobj(self.bucket, self._clave(clave), archivo)
+        except Exception:
+            archivo.close()
+            raise FileNotFoundError(clave)
+        archivo.seek(0)
+        return archivo
+
+    def eliminar(self, clave):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self._clave(clave))
+
+    def url_descarga(self, clave, nombre_descarga=None, tipo=None):
+        parametros = {'Bucket': self.bucket, 'Key': self._clave(clave)}
+        if nombre_descarga:
+            parametros['ResponseContentDisposition'] = f'attachment; filename="{nombre_descarga}"'
+        if tipo:
+            parametros['ResponseContentType'] = tipo
+        return self.cliente.generate_presigned_url('get_object', Params=parametros, ExpiresIn=self.expiracion)
+
+def crear_almacenamiento():
+    if app.config['ALMACENAMIENTO'] == 's3':
+        return AlmacenamientoS3(
+            app.config['S3_BUCKET'],
+            prefijo=app.config['S3_PREFIJO'],
+            endpoint_url=app.config['S3_ENDPOINT_URL'],
+            region=app.config['S3_REGION'],
+            expiracion=app.config['S3_URL_EXPIRACION_SEGUNDOS']
+        )
+    return AlmacenamientoLocal(os.path.join(app.root_path, 'static'))
+
+almacenamiento = crear_almacenamiento()
+
+def clave_documento(nombre_archivo):
+    return app.config['DOCUMENTOS_PREFIJO'] + nombre_archivo
+
+@contextlib.contextmanager
+def archivo_local(clave):
+    # Ruta en disco de un archivo del almacenamiento, para herramientas externas (antivirus,
+    # ffmpeg...). Con S3 se descarga a un temporal que se borra al salir del bloque.
+    if isinstance(almacenamiento, AlmacenamientoLocal):
+        yield almacenamiento.ruta(clave)
+        return
+    descriptor, temporal = tempfile.mkstemp(suffix=os.path.splitext(clave)[1])
+    try:
+        with os.fdopen(descriptor, 'wb') as destino, almacenamiento.abrir(clave) as origen:
+            shutil.copyfileobj(origen, destino, app.config['BLOQUE_SUBIDA_BYTES'])
+        yield temporal
+    finally:
+        os.remove(temporal)
+
+def _sha256_archivo(f):
+    sha = hashlib.sha256()
+    for bloque in iter(lambda: f.read(app.config['BLOQUE_SUBIDA_BYTES']), b''):
+        sha.update(bloque)
+    return sha.hexdigest()
+
+def calcular_sha256(clave):
+    with almacenamiento.abrir(clave) as f:
+        return _sha256_archivo(f)
+
+def calcular_sha256_ruta(ruta):
+    with open(ruta, 'rb') as f:
+        return _sha256_archivo(f)
+
+def guardar_archivo_por_contenido(archivo, prefijo, extension, tipo=None):
+    # Copia la subida a un temporal por bloques calculando su SHA-256 al mismo tiempo y la pasa
+    # al almacenamiento con el hash como nombre: un mismo archivo subido por varios profesores
+    # se guarda una sola vez. Devuelve (nombre, hash); la clave en el almacenamiento es prefijo + nombre.
+    sha = hashlib.sha256()
+    if almacenamiento.directorio_temporal:
+        os.makedirs(almacenamiento.directorio_temporal, exist_ok=True)
+    descriptor, temporal = tempfile.mkstemp(dir=almacenamiento.directorio_temporal, suffix='.parcial')
+    try:
+        with os.fdopen(descriptor, 'wb') as destino:
+            for bloque in iter(lambda: archivo.stream.read(app.config['BLOQUE_SUBIDA_BYTES']), b''):
+                sha.update(bloque)
+                destino.write(bloque)
+        digest = sha.hexdigest()
+        nombre = f"{digest}{extension}"
+        almacenamiento.guardar(prefijo + nombre, temporal, tipo)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return nombre, digest
 
 # Create database tables
 with app.app_context():
     db.create_all()
+    actualizar_esquema()
+    inicializar_indice_busqueda()
 
 # Context processor to add date information to all templates
 @app.context_processor
 def inject_now():
     return {'now': datetime.datetime.now()}
 
+@app.template_global()
+def url_archivo(clave, tipo=None):
+    # URL pública de un archivo subido: estático en disco local o URL firmada en S3
+    return almacenamiento.url_descarga(clave, tipo=tipo) or url_for('static', filename=clave)
+
+@app.template_global()
+def poster_estatico(video):
+    # Portada generada por `flask videos procesar-estaticos` junto a un video de static/, si existe
+    poster = os.path.splitext(video)[0] + '.jpg'
+    if os.path.exists(os.path.join(app.static_folder, poster)):
+        return url_for('static', filename=poster)
+    return ''
+
 # Routes
 
 @app.route('/')
@@ -412,26 +1207,742 @@ def sugerencias():
 def biblioteca():
     return render_template('recursos/biblioteca.html')
 
+class CacheMetadatosPDF:
+    """
+    Caché LRU de metadatos PDF, validada por tamaño y fecha de modificación del archivo
+    """
+    def __init__(self, max_entradas, max_bytes):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()  # ruta -> (clave, metadatos, tamaño estimado)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    @staticmethod
+    def _estimar_tamano(metadatos):
+        if not metadatos:
+            return sys.getsizeof(None)
+        return sys.getsizeof(metadatos) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in metadatos.items())
+
+    def obtener(self, ruta, clave):
+        with self._lock:
+            entrada = self._entradas.get(ruta)
+            if entrada is None or entrada[0] != clave:
+                self.fallos += 1
+                return False, None
+            self._entradas.move_to_end(ruta)
+            self.aciertos += 1
+            return True, entrada[1]
+
+    def guardar(self, ruta, clave, metadatos):
+        tamano = self._estimar_tamano(metadatos)
+        with self._lock:
+            anterior = self._entradas.pop(ruta, None)
+            if anterior:
+                self._bytes -= anterior[2]
+            self._entradas[ruta] = (clave, metadatos, tamano)
+            self._bytes += tamano
+            while self._entradas and (len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes):
+                _, (_, _, liberado) = self._entradas.popitem(last=False)
+                self._bytes -= liberado
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._bytes = 0
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'bytes': self._bytes,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos
+            }
+
+cache_metadatos_pdf = CacheMetadatosPDF(app.config['PDF_CACHE_MAX_ENTRIES'], app.config['PDF_CACHE_MAX_BYTES'])
+
+def _leer_metadatos_pdf(origen):
+    # origen puede ser una ruta o un archivo abierto en modo binario
+    try:
+        reader = PyPDF2.PdfReader(origen)
+        info = reader.metadata
+        num_paginas = len(reader.pages)
+        return {
+            'titulo': info.title,
+            'autor': info.author,
+            'num_paginas': num_paginas,
+            'productor': info.producer,
+            'asunto': info.subject,
+            'creado': info.creation_date
+        }
+    except Exception as e:
+        print(f"Error extrayendo metadatos: {e}")
+        return None
+
 def extraer_metadatos_pdf(nombre_archivo):
-    ruta_pdf = os.path.join(app.root_path, 'static', 'repositorio', 'documents', nombre_archivo)
-    if not os.path.exists(ruta_pdf):
+    clave = clave_documento(nombre_archivo)
+    # Solo se vuelve a leer el PDF si cambió en el almacenamiento (tamaño y mtime o ETag)
+    version = almacenamiento.info(clave)
+    if version is None:
         return None
+    encontrado, metadatos = cache_metadatos_pdf.obtener(clave, version)
+    if not encontrado:
+        try:
+            with almacenamiento.abrir(clave) as f:
+                metadatos = _leer_metadatos_pdf(f)
+        except OSError:
+            return None
+        cache_metadatos_pdf.guardar(clave, version, metadatos)
+    return dict(metadatos) if metadatos else None
+
+def extraer_texto_pdf(nombre_archivo):
+    # Devuelve el texto de cada página como [(numero_pagina, texto)]
     try:
-        with open(ruta_pdf, 'rb') as f:
+        with almacenamiento.abrir(clave_documento(nombre_archivo)) as f:
             reader = PyPDF2.PdfReader(f)
-            info = reader.metadata
-            num_paginas = len(reader.pages)
-            return {
-                'titulo': info.title,
-                'autor': info.author,
-                'num_paginas': num_paginas,
-                'productor': info.producer,
-                'asunto': info.subject,
-                'creado': info.creation_date
-            }
+            return [(numero, (pagina.extract_text() or '').replace('\x00', ''))
+                    for numero, pagina in enumerate(reader.pages, start=1)]
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        print(f"Error extrayendo metadatos: {e}")
+        print(f"Error extrayendo texto: {e}")
+        return None
+
+def dividir_en_fragmentos(paginas, tamano=None):
+    # Agrupa las palabras de cada página en fragmentos de tamaño acotado para indexar y mostrar
+    tamano = tamano or app.config['FRAGMENTO_TEXTO_CARACTERES']
+    for numero_pagina, texto in paginas:
+        actual = []
+        longitud = 0
+        for palabra in texto.split():
+            if actual and longitud + len(palabra) + 1 > tamano:
+                yield numero_pagina, ' '.join(actual)
+                actual = []
+                longitud = 0
+            actual.append(palabra)
+            longitud += len(palabra) + 1
+        if actual:
+            yield numero_pagina, ' '.join(actual)
+
+def indexar_texto_documento(documento_id):
+    documento = db.session.get(DocumentoRepositorio, documento_id)
+    if not documento or not documento.archivo_pdf:
+        return 0
+    paginas = extraer_texto_pdf(documento.archivo_pdf)
+    if paginas is None:
+        return 0
+
+    conexion = db.session.connection()
+    desindexar_fragmentos(conexion, documento_id)
+    FragmentoTextoDocumento.query.filter_by(documento_id=documento_id).delete()
+    fragmentos = [
+        FragmentoTextoDocumento(documento_id=documento_id, numero=numero, pagina=pagina, texto=texto)
+        for numero, (pagina, texto) in enumerate(dividir_en_fragmentos(paginas))
+    ]
+    db.session.add_all(fragmentos)
+    db.session.flush()
+    indexar_fragmentos(conexion, fragmentos)
+    db.session.commit()
+    return len(fragmentos)
+
+# Cola de tareas en segundo plano guardada en la base de datos. Las subidas solo encolan el
+# trabajo pesado (metadatos, texto, antivirus...) en la misma transacción que crea el registro;
+# los trabajadores (`flask --app main tareas trabajar`, o el hilo interno en desarrollo)
+# toman las tareas con un UPDATE atómico, las reintentan con espera exponencial y dejan el
+# estado en la tabla para que las páginas de subida lo consulten.
+MANEJADORES_TAREAS = {}  # tipo -> función(entidad, entidad_id, **argumentos)
+
+def manejador_tarea(tipo):
+    def registrar(funcion):
+        MANEJADORES_TAREAS[tipo] = funcion
+        return funcion
+    return registrar
+
+_trabajador_interno = {'pid': None, 'aviso': threading.Event()}
+
+def encolar_tarea(tipo, entidad, entidad_id, **argumentos):
+    # Se agrega a la sesión actual: la tarea solo existe si la transacción del llamador se confirma
+    tarea = Tarea(
+        tipo=tipo,
+        entidad=entidad,
+        entidad_id=entidad_id,
+        argumentos=json.dumps(argumentos) if argumentos else None,
+        max_intentos=app.config['TAREAS_MAX_INTENTOS']
+    )
+    db.session.add(tarea)
+    if app.config['TAREAS_TRABAJADOR_INTERNO'] and has_request_context():
+        iniciar_trabajador_interno()
+    return tarea
+
+def encolar_tareas(tipos, entidad, entidad_id):
+    return [encolar_tarea(tipo, entidad, entidad_id) for tipo in tipos]
+
+def tomar_tarea(trabajador):
+    # Marca como en proceso la próxima tarea disponible. También recupera las tareas cuyo
+    # trabajador murió sin terminarlas (bloqueo vencido).
+    ahora = datetime.datetime.utcnow()
+    disponible = db.or_(
+        db.and_(Tarea.estado == 'pendiente', Tarea.ejecutar_desde <= ahora),
+        db.and_(Tarea.estado == 'en_proceso', Tarea.bloqueada_hasta < ahora)
+    )
+    candidata = select(Tarea.id).where(disponible).order_by(Tarea.ejecutar_desde, Tarea.id).limit(1)
+    if db.engine.dialect.name == 'postgresql':
+        candidata = candidata.with_for_update(skip_locked=True)
+    tarea_id = db.session.execute(
+        update(Tarea)
+        .where(Tarea.id == candidata.scalar_subquery(), disponible)
+        .values(
+            estado='en_proceso',
+            intentos=Tarea.intentos + 1,
+            trabajador=trabajador,
+            bloqueada_hasta=ahora + datetime.timedelta(seconds=app.config['TAREAS_BLOQUEO_SEGUNDOS'])
+        )
+        .returning(Tarea.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    db.session.commit()
+    return db.session.get(Tarea, tarea_id) if tarea_id else None
+
+def _renovar_bloqueo(motor, tarea_id, trabajador, detener):
+    # Latido: mientras el manejador corre, el bloqueo se extiende para que ningún otro
+    # trabajador tome la tarea por vencida. Usa su propia conexión, fuera de la sesión.
+    intervalo = max(app.config['TAREAS_BLOQUEO_SEGUNDOS'] / 3, 1)
+    while not detener.wait(intervalo):
+        try:
+            with motor.begin() as conexion:
+                conexion.execute(
+                    update(Tarea.__table__)
+                    .where(Tarea.id == tarea_id, Tarea.trabajador == trabajador, Tarea.estado == 'en_proceso')
+                    .values(bloqueada_hasta=datetime.datetime.utcnow() + datetime.timedelta(seconds=app.config['TAREAS_BLOQUEO_SEGUNDOS']))
+                )
+        except Exception as e:
+            logging.warning(f"No se pudo renovar el bloqueo de la tarea {tarea_id}: {e}")
+
+def ejecutar_tarea(tarea):
+    tarea_id = tarea.id
+    trabajador = tarea.trabajador
+    detener = threading.Event()
+    latido = threading.Thread(target=_renovar_bloqueo, args=(db.engine, tarea_id, trabajador, detener), daemon=True)
+    latido.start()
+    try:
+        if tarea.intentos > tarea.max_intentos:
+            raise RuntimeError('Se agotaron los intentos (el trabajador se detuvo durante la tarea).')
+        manejador = MANEJADORES_TAREAS.get(tarea.tipo)
+        if manejador is None:
+            raise LookupError(f'Tipo de tarea desconocido: {tarea.tipo}')
+        manejador(tarea.entidad, tarea.entidad_id, **json.loads(tarea.argumentos or '{}'))
+    except Exception as e:
+        db.session.rollback()
+        tarea = db.session.get(Tarea, tarea_id)
+        valores = {'error': f'{type(e).__name__}: {e}'}
+        if tarea.intentos >= tarea.max_intentos:
+            valores.update(estado='fallida', fecha_fin=datetime.datetime.utcnow())
+            logging.error(f"Tarea {tarea.id} ({tarea.tipo} {tarea.entidad} {tarea.entidad_id}) fallida: {e}")
+        else:
+            espera = app.config['TAREAS_BACKOFF_SEGUNDOS'] * 2 ** (tarea.intentos - 1)
+            valores.update(estado='pendiente', ejecutar_desde=datetime.datetime.utcnow() + datetime.timedelta(seconds=espera))
+            logging.warning(f"Tarea {tarea.id} ({tarea.tipo}) falló, se reintenta en {espera}s: {e}")
+    else:
+        valores = {'estado': 'completada', 'error': None, 'fecha_fin': datetime.datetime.utcnow()}
+    finally:
+        detener.set()
+        latido.join()
+    # Solo el trabajador que tiene la tarea escribe su resultado
+    valores['bloqueada_hasta'] = None
+    actualizadas = db.session.execute(
+        update(Tarea)
+        .where(Tarea.id == tarea_id, Tarea.trabajador == trabajador, Tarea.estado == 'en_proceso')
+        .values(**valores)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not actualizadas:
+        logging.warning(f"Tarea {tarea_id}: la tomó otro trabajador, no se guarda este resultado")
         return None
+    return valores['estado']
+
+def trabajar(trabajador=None, una_vez=False, aviso=None):
+    # Ejecuta tareas hasta que se interrumpa; con una_vez, termina cuando la cola queda vacía
+    trabajador = trabajador or f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        try:
+            tarea = tomar_tarea(trabajador)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error tomando tareas: {e}")
+            tarea = None
+        if tarea:
+            tarea_id = tarea.id
+            try:
+                ejecutar_tarea(tarea)
+            except Exception as e:
+                # p. ej. "database is locked" al guardar el resultado: la tarea se recupera al vencer su bloqueo
+                db.session.rollback()
+                logging.error(f"Error ejecutando la tarea {tarea_id}: {e}")
+            continue
+        if una_vez:
+            return
+        db.session.remove()
+        if aviso:
+            aviso.wait(app.config['TAREAS_INTERVALO_SEGUNDOS'])
+            aviso.clear()
+        else:
+            time.sleep(app.config['TAREAS_INTERVALO_SEGUNDOS'])
+
+def _ciclo_trabajador_interno():
+    with app.app_context():
+        trabajar(f'{socket.gethostname()}:{os.getpid()}:interno', aviso=_trabajador_interno['aviso'])
+
+def iniciar_trabajador_interno():
+    # Un hilo por proceso, iniciado en el propio worker (después del fork de gunicorn)
+    if _trabajador_interno['pid'] != os.getpid():
+        _trabajador_interno['pid'] = os.getpid()
+        threading.Thread(target=_ciclo_trabajador_interno, name='cola-tareas', daemon=True).start()
+    _trabajador_interno['aviso'].set()
+
+def estado_tareas(entidad, entidad_id):
+    tareas = Tarea.query.filter_by(entidad=entidad, entidad_id=entidad_id).order_by(Tarea.id).all()
+    estados = {tarea.estado for tarea in tareas}
+    if 'fallida' in estados:
+        general = 'fallida'
+    elif estados & {'pendiente', 'en_proceso'}:
+        general = 'en_proceso'
+    else:
+        general = 'completada'
+    return {
+        'estado': general,
+        'tareas': [
+            {'tipo': tarea.tipo, 'estado': tarea.estado, 'intentos': tarea.intentos, 'error': tarea.error}
+            for tarea in tareas
+        ]
+    }
+
+def archivo_de_entidad(entidad, entidad_id):
+    # (registro, clave en el almacenamiento) del documento o video de una tarea
+    if entidad == 'documento':
+        registro = db.session.get(DocumentoRepositorio, entidad_id)
+        clave = clave_documento(registro.archivo_pdf) if registro and registro.archivo_pdf else None
+    else:
+        registro = db.session.get(VideoClase, entidad_id)
+        clave = registro.archivo_video if registro else None
+    return registro, clave
+
+@manejador_tarea('metadatos_pdf')
+def tarea_metadatos_pdf(entidad, documento_id):
+    documento = db.session.get(DocumentoRepositorio, documento_id)
+    if documento and documento.archivo_pdf:
+        guardar_metadatos_documento(documento, extraer_metadatos_pdf(documento.archivo_pdf))
+        db.session.commit()
+
+@manejador_tarea('indexar_texto')
+def tarea_indexar_texto(entidad, documento_id):
+    indexar_texto_documento(documento_id)
+
+def clave_miniatura(sha256, ancho):
+    return f"{app.config['MINIATURAS_PREFIJO']}{sha256[:2]}/{sha256}-{ancho}.webp"
+
+def generar_miniaturas_pdf(clave_pdf, sha256):
+    # Renderiza la primera página una sola vez al ancho mayor y la reduce a cada tamaño.
+    # Las miniaturas dependen solo del contenido: un PDF repetido reutiliza las existentes.
+    anchos = app.config['MINIATURAS_ANCHOS']
+    if all(almacenamiento.existe(clave_miniatura(sha256, ancho)) for ancho in anchos):
+        return True
+    binario = shutil.which(app.config['PDFTOPPM_BINARIO'])
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if not binario or Image is None:
+        logging.warning("Miniaturas desactivadas: se requieren pdftoppm (poppler-utils) y Pillow")
+        return False
+    with archivo_local(clave_pdf) as ruta, tempfile.TemporaryDirectory() as temporal:
+        base = os.path.join(temporal, 'portada')
+        subprocess.run(
+            [binario, '-f', '1', '-l', '1', '-singlefile', '-png',
+             '-scale-to-x', str(max(anchos)), '-scale-to-y', '-1', ruta, base],
+            check=True, capture_output=True, timeout=120
+        )
+        with Image.open(base + '.png') as portada:
+            portada = portada.convert('RGB')
+            for ancho in anchos:
+                alto = max(round(portada.height * ancho / portada.width), 1)
+                destino = os.path.join(temporal, f'{ancho}.webp')
+                portada.resize((ancho, alto), Image.LANCZOS).save(destino, 'WEBP', quality=80, method=6)
+                almacenamiento.guardar(clave_miniatura(sha256, ancho), destino, 'image/webp')
+    return True
+
+@manejador_tarea('miniatura_pdf')
+def tarea_miniatura_pdf(entidad, documento_id):
+    documento = db.session.get(DocumentoRepositorio, documento_id)
+    if not documento or not documento.archivo_pdf:
+        return
+    clave = clave_documento(documento.archivo_pdf)
+    if not documento.sha256:
+        documento.sha256 = calcular_sha256(clave)
+    if generar_miniaturas_pdf(clave, documento.sha256):
+        documento.miniatura_sha256 = documento.sha256
+    db.session.commit()
+
+def probar_video(ruta):
+    # Ancho, alto y duración (segundos) del primer stream de video, leídos con ffprobe
+    resultado = subprocess.run(
+        [app.config['FFPROBE_BINARIO'], '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height:format=duration', '-of', 'json', ruta],
+        check=True, capture_output=True, text=True, timeout=120
+    )
+    datos = json.loads(resultado.stdout)
+    stream = (datos.get('streams') or [{}])[0]
+    duracion = (datos.get('format') or {}).get('duration')
+    return {
+        'ancho': stream.get('width'),
+        'alto': stream.get('height'),
+        'duracion': float(duracion) if duracion not in (None, 'N/A') else None
+    }
+
+TIPOS_HLS = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+def empaquetar_hls(ruta, directorio):
+    # Una pasada de ffmpeg por variante (H.264 + AAC, keyframes alineados al tamaño de segmento
+    # para poder cambiar de calidad entre segmentos) y una lista maestra que las agrupa
+    info = probar_video(ruta)
+    segundos = app.config['HLS_SEGUNDOS_SEGMENTO']
+    variantes = [v for v in app.config['HLS_VARIANTES'] if not info['alto'] or v[0] <= info['alto']]
+    variantes = variantes or app.config['HLS_VARIANTES'][:1]
+    maestra = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for alto, kbps_video, kbps_audio in variantes:
+        carpeta = os.path.join(directorio, f'{alto}p')
+        os.makedirs(carpeta)
+        subprocess.run(
+            [app.config['FFMPEG_BINARIO'], '-v', 'error', '-y', '-i', ruta,
+             '-map', '0:v:0', '-map', '0:a:0?',
+             '-vf', f'scale=-2:{alto}', '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+             '-b:v', f'{kbps_video}k', '-maxrate', f'{int(kbps_video * 1.07)}k', '-bufsize', f'{int(kbps_video * 1.5)}k',
+             '-force_key_frames', f'expr:gte(t,n_forced*{segundos})', '-sc_threshold', '0',
+             '-c:a', 'aac', '-b:a', f'{kbps_audio}k', '-ac', '2',
+             '-f', 'hls', '-hls_time', str(segundos), '-hls_playlist_type', 'vod',
+             '-hls_segment_filename', os.path.join(carpeta, 'seg_%05d.ts'),
+             os.path.join(carpeta, 'index.m3u8')],
+            check=True, capture_output=True, timeout=6 * 60 * 60
+        )
+        ancho = round(info['ancho'] * alto / info['alto'] / 2) * 2 if info['ancho'] and info['alto'] else None
+        atributos = f'BANDWIDTH={(kbps_video + kbps_audio) * 1100}'
+        if ancho:
+            atributos += f',RESOLUTION={ancho}x{alto}'
+        maestra += [f'#EXT-X-STREAM-INF:{atributos}', f'{alto}p/index.m3u8']
+    with open(os.path.join(directorio, 'master.m3u8'), 'w') as f:
+        f.write('\n'.join(maestra) + '\n')
+
+EXTENSIONES_MP4 = {'.mp4', '.m4v', '.mov'}
+
+def mp4_es_faststart(ruta):
+    # Recorre las cajas de primer nivel del MP4: es faststart si 'moov' aparece antes que 'mdat'
+    with open(ruta, 'rb') as f:
+        while True:
+            cabecera = f.read(8)
+            if len(cabecera) < 8:
+                return True
+            tamano = int.from_bytes(cabecera[:4], 'big')
+            tipo = cabecera[4:]
+            if tipo == b'moov':
+                return True
+            if tipo == b'mdat':
+                return False
+            if tamano == 1:
+                # Tamaño de 64 bits a continuación; la cabecera ocupa 16 bytes
+                extendido = f.read(8)
+                if len(extendido) < 8 or int.from_bytes(extendido, 'big') < 16:
+                    return False
+                tamano = int.from_bytes(extendido, 'big') - 8
+            elif tamano == 0:
+                return True
+            elif tamano < 8:
+                # Caja mal formada: no se puede avanzar con seguridad
+                return False
+            f.seek(tamano - 8, os.SEEK_CUR)
+
+def remux_faststart(ruta, destino):
+    # Copia los streams sin recodificar y mueve el índice (moov) al inicio del archivo
+    subprocess.run(
+        [app.config['FFMPEG_BINARIO'], '-v', 'error', '-y', '-i', ruta, '-map', '0', '-c', 'copy',
+         '-ignore_unknown', '-fflags', '+bitexact', '-movflags', '+faststart', destino],
+        check=True, capture_output=True, timeout=60 * 60
+    )
+
+def extraer_poster(ruta, destino, duracion=None):
+    # Un cuadro al 10 % del video (máximo a los 10 s) para evitar fundidos iniciales en negro
+    segundo = min(duracion * 0.1, 10) if duracion else 0
+    subprocess.run(
+        [app.config['FFMPEG_BINARIO'], '-v', 'error', '-y', '-ss', f'{segundo:.2f}', '-i', ruta,
+         '-frames:v', '1', '-vf', f"scale='min({app.config['POSTER_ANCHO_MAX']},iw)':-2", '-q:v', '3', destino],
+        check=True, capture_output=True, timeout=120
+    )
+
+def ffmpeg_disponible():
+    return bool(shutil.which(app.config['FFMPEG_BINARIO']) and shutil.which(app.config['FFPROBE_BINARIO']))
+
+@manejador_tarea('procesar_video')
+def tarea_procesar_video(entidad, video_id):
+    video = db.session.get(VideoClase, video_id)
+    if not video or not video.archivo_video:
+        return
+    if not ffmpeg_disponible():
+        logging.warning("Procesamiento de video desactivado: se requieren ffmpeg y ffprobe")
+    else:
+        with archivo_local(video.archivo_video) as ruta, tempfile.TemporaryDirectory() as temporal:
+            info = probar_video(ruta)
+            if info['duracion']:
+                video.duracion_minutos = max(round(info['duracion'] / 60), 1)
+            extension = os.path.splitext(video.archivo_video)[1].lower()
+            remuxado = None
+            if extension in EXTENSIONES_MP4 and not mp4_es_faststart(ruta):
+                # El archivo remuxado es contenido nuevo: se guarda con su propio hash
+                remuxado = os.path.join(temporal, 'faststart' + extension)
+                remux_faststart(ruta, remuxado)
+                video.sha256 = calcular_sha256_ruta(remuxado)
+            if not video.sha256:
+                video.sha256 = calcular_sha256(video.archivo_video)
+            clave_poster = f"{app.config['POSTERS_PREFIJO']}{video.sha256}.jpg"
+            if not almacenamiento.existe(clave_poster):
+                destino = os.path.join(temporal, 'poster.jpg')
+                extraer_poster(remuxado or ruta, destino, info['duracion'])
+                almacenamiento.guardar(clave_poster, destino, 'image/jpeg')
+            video.poster = clave_poster
+            if remuxado:
+                # El paquete HLS anterior corresponde al contenido viejo: se vuelve a empaquetar
+                video.hls_playlist = None
+                anterior = video.archivo_video
+                video.archivo_video = app.config['VIDEOS_PREFIJO'] + video.sha256 + extension
+                almacenamiento.guardar(video.archivo_video, remuxado, 'video/mp4')
+                # El original se borra en otra tarea, que solo existe si esta transacción se confirma
+                encolar_tarea('eliminar_video', 'video', video.id, clave=anterior)
+    # El empaquetado HLS va después, sobre el archivo ya definitivo
+    if app.config['HLS_ACTIVO'] and not video.hls_playlist:
+        encolar_tarea('empaquetar_hls', 'video', video.id)
+    db.session.commit()
+
+@manejador_tarea('eliminar_video')
+def tarea_eliminar_video(entidad, video_id, clave):
+    # Archivo reemplazado por su versión remuxada: solo se borra si ningún video lo usa
+    if not VideoClase.query.filter_by(archivo_video=clave).first():
+        almacenamiento.eliminar(clave)
+
+@manejador_tarea('empaquetar_hls')
+def tarea_empaquetar_hls(entidad, video_id):
+    video = db.session.get(VideoClase, video_id)
+    if not video or not video.archivo_video:
+        return
+    if not video.sha256:
+        video.sha256 = calcular_sha256(video.archivo_video)
+    # Los segmentos dependen solo del contenido: un video repetido reutiliza el paquete existente
+    prefijo = f"{app.config['HLS_PREFIJO']}{video.sha256}/"
+    if not almacenamiento.existe(prefijo + 'master.m3u8'):
+        if not shutil.which(app.config['FFMPEG_BINARIO']) or not shutil.which(app.config['FFPROBE_BINARIO']):
+            raise RuntimeError('HLS_ACTIVO requiere ffmpeg y ffprobe instalados')
+        with archivo_local(video.archivo_video) as ruta, tempfile.TemporaryDirectory() as temporal:
+            empaquetar_hls(ruta, temporal)
+            # La lista maestra se sube al final: si existe, el paquete está completo
+            archivos = sorted(
+                os.path.relpath(os.path.join(carpeta, nombre), temporal)
+                for carpeta, _, nombres in os.walk(temporal) for nombre in nombres
+            )
+            archivos.remove('master.m3u8')
+            for relativo in archivos + ['master.m3u8']:
+                almacenamiento.guardar(
+                    prefijo + relativo.replace(os.sep, '/'),
+                    os.path.join(temporal, relativo),
+                    TIPOS_HLS.get(os.path.splitext(relativo)[1])
+                )
+    video.hls_playlist = prefijo + 'master.m3u8'
+    db.session.commit()
+
+@manejador_tarea('escaneo_virus')
+def tarea_escaneo_virus(entidad, entidad_id):
+    comando = app.config['ESCANER_VIRUS_COMANDO']
+    registro, clave = archivo_de_entidad(entidad, entidad_id)
+    if not comando or not clave:
+        return
+    with archivo_local(clave) as ruta:
+        resultado = subprocess.run(shlex.split(comando) + [ruta], capture_output=True, text=True)
+    if resultado.returncode == 1:
+        # Archivo infectado: se retira de la vista sin borrarlo, para que un administrador lo revise
+        registro.activo = False
+        db.session.commit()
+        logging.warning(f"Antivirus: {entidad} {entidad_id} infectado y desactivado: {resultado.stdout.strip()}")
+    elif resultado.returncode != 0:
+        raise RuntimeError(f'El antivirus terminó con código {resultado.returncode}: {resultado.stderr.strip()}')
+
+# Comandos de la cola de tareas: flask --app main tareas <comando>
+tareas_cli = AppGroup('tareas', help='Cola de tareas en segundo plano.')
+app.cli.add_command(tareas_cli)
+
+def _proceso_trabajador(numero):
+    # Cada proceso abre sus propias conexiones: las heredadas del padre no se comparten
+    with app.app_context():
+        db.engine.dispose(close=False)
+        trabajar(f'{socket.gethostname()}:{os.getpid()}:{numero}')
+
+@tareas_cli.command('trabajar')
+@click.option('--procesos', type=int, default=1, show_default=True, help='Procesos trabajadores.')
+@click.option('--una-vez', is_flag=True, help='Termina cuando la cola queda vacía.')
+def trabajar_comando(procesos, una_vez):
+    """Ejecuta las tareas pendientes (metadatos, texto, antivirus...)."""
+    if una_vez or procesos <= 1:
+        trabajar(una_vez=una_vez)
+        return
+    hijos = [multiprocessing.Process(target=_proceso_trabajador, args=(numero,), daemon=True) for numero in range(procesos)]
+    for hijo in hijos:
+        hijo.start()
+    try:
+        for hijo in hijos:
+            hijo.join()
+    except KeyboardInterrupt:
+        for hijo in hijos:
+            hijo.terminate()
+
+@tareas_cli.command('estado')
+def estado_tareas_comando():
+    """Muestra cuántas tareas hay por tipo y estado."""
+    filas = db.session.query(Tarea.tipo, Tarea.estado, func.count(Tarea.id)).group_by(Tarea.tipo, Tarea.estado).order_by(Tarea.tipo, Tarea.estado)
+    for tipo, estado, cantidad in filas:
+        print(f"{tipo:<20} {estado:<12} {cantidad}")
+
+@tareas_cli.command('reintentar')
+@click.option('--tipo', default=None, help='Solo las tareas fallidas de este tipo.')
+def reintentar_tareas_comando(tipo):
+    """Vuelve a encolar las tareas fallidas."""
+    query = Tarea.query.filter_by(estado='fallida')
+    if tipo:
+        query = query.filter_by(tipo=tipo)
+    total = query.update({
+        'estado': 'pendiente', 'intentos': 0, 'ejecutar_desde': datetime.datetime.utcnow(), 'fecha_fin': None
+    }, synchronize_session=False)
+    db.session.commit()
+    print(f"Se reencolaron {total} tareas.")
+
+# Política de contraseñas: flask --app main contrasenas <comando>
+contrasenas_cli = AppGroup('contrasenas', help='Política de hash de contraseñas.')
+app.cli.add_command(contrasenas_cli)
+
+METODOS_BENCHMARK = ['pbkdf2:sha256:100000', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000',
+                     'scrypt:16384:8:1', 'scrypt:32768:8:1', 'scrypt:65536:8:1']
+
+@contrasenas_cli.command('benchmark')
+@click.option('--metodo', 'metodos', multiple=True, help='Método de werkzeug a medir (repetible), p. ej. scrypt:32768:8:1.')
+@click.option('--segundos', type=float, default=2.0, show_default=True, help='Tiempo de medición por método.')
+def benchmark_contrasenas_comando(metodos, segundos):
+    """Mide cuántos inicios de sesión por segundo verifica un núcleo con cada método."""
+    actual = metodo_hash_contrasena()
+    metodos = list(metodos) or list(dict.fromkeys([actual] + METODOS_BENCHMARK))
+    print(f"{'método':<26} {'ms/login':>9} {'logins/s/núcleo':>16}")
+    for metodo in metodos:
+        password_hash = generate_password_hash('benchmark-contraseña', method=metodo)
+        verificaciones = 0
+        inicio = time.perf_counter()
+        # check_password_hash es CPU pura: un proceso mide la capacidad de un núcleo
+        while True:
+            check_password_hash(password_hash, 'benchmark-contraseña')
+            verificaciones += 1
+            transcurrido = time.perf_counter() - inicio
+            if transcurrido >= segundos:
+                break
+        por_segundo = verificaciones / transcurrido
+        marca = '  (actual)' if metodo == actual else ''
+        print(f"{metodo:<26} {1000 / por_segundo:>9.1f} {por_segundo:>16.1f}{marca}")
+    print(f"Núcleos disponibles: {os.cpu_count()}")
+
+# Comandos de procesamiento de videos: flask --app main videos <comando>
+videos_cli = AppGroup('videos', help='Procesamiento de los videos de clase.')
+app.cli.add_command(videos_cli)
+
+@videos_cli.command('procesar')
+@click.option('--todos', is_flag=True, help='Vuelve a encolar también los videos ya procesados.')
+def procesar_videos_comando(todos):
+    """Encola faststart, portada y duración real de los videos subidos."""
+    query = VideoClase.query.filter(VideoClase.archivo_video.isnot(None))
+    if not todos:
+        query = query.filter(VideoClase.poster.is_(None))
+    video_ids = [video_id for (video_id,) in query.with_entities(VideoClase.id).all()]
+    for video_id in video_ids:
+        encolar_tarea('procesar_video', 'video', video_id)
+    db.session.commit()
+    print(f"Se encolaron {len(video_ids)} videos. Ejecuta `flask --app main tareas trabajar` para procesarlos.")
+
+@videos_cli.command('procesar-estaticos')
+@click.option('--directorio', default=None, help='Carpeta dentro de static/ (por defecto, los videos del uniforme).')
+def procesar_estaticos_comando(directorio):
+    """Remux faststart y portada (<video>.jpg) de los MP4 de una carpeta de static/."""
+    if not ffmpeg_disponible():
+        raise click.ClickException('Se requieren ffmpeg y ffprobe instalados.')
+    carpeta = os.path.join(app.static_folder, directorio or app.config['VIDEOS_ESTATICOS_DIRECTORIO'])
+    for nombre in sorted(os.listdir(carpeta)):
+        base, extension = os.path.splitext(nombre)
+        if extension.lower() not in EXTENSIONES_MP4:
+            continue
+        ruta = os.path.join(carpeta, nombre)
+        acciones = []
+        if not mp4_es_faststart(ruta):
+            # Se escribe al lado y se reemplaza de forma atómica: el sitio nunca sirve un archivo a medias
+            temporal = os.path.join(carpeta, f'.{base}.faststart{extension}')
+            try:
+                remux_faststart(ruta, temporal)
+                os.replace(temporal, ruta)
+            finally:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+            acciones.append('faststart')
+        info = probar_video(ruta)
+        poster = os.path.join(carpeta, base + '.jpg')
+        if not os.path.exists(poster) or os.path.getmtime(poster) < os.path.getmtime(ruta):
+            extraer_poster(ruta, poster, info['duracion'])
+            acciones.append('portada')
+        duracion = f"{info['duracion']:.1f}s" if info['duracion'] else '?'
+        print(f"{nombre}: {duracion} {', '.join(acciones) or 'sin cambios'}")
+
+@videos_cli.command('empaquetar-hls')
+@click.option('--todos', is_flag=True, help='Vuelve a encolar también los videos ya empaquetados.')
+def empaquetar_hls_comando(todos):
+    """Encola el empaquetado HLS de los videos subidos."""
+    query = VideoClase.query.filter(VideoClase.archivo_video.isnot(None))
+    if not todos:
+        query = query.filter(VideoClase.hls_playlist.is_(None))
+    video_ids = [video_id for (video_id,) in query.with_entities(VideoClase.id).all()]
+    for video_id in video_ids:
+        encolar_tarea('empaquetar_hls', 'video', video_id)
+    db.session.commit()
+    print(f"Se encolaron {len(video_ids)} videos. Ejecuta `flask --app main tareas trabajar` para empaquetarlos.")
+
+def separar_autores(autores_raw):
+    # Los autores pueden estar separados por coma o punto y coma
+    if ';' in autores_raw:
+        return [a.strip() for a in autores_raw.split(';')]
+    elif ',' in autores_raw:
+        return [a.strip() for a in autores_raw.split(',')]
+    return [autores_raw.strip()]
+
+def valores_metadatos(metadatos):
+    creado = metadatos.get('creado')
+    return {
+        'titulo': metadatos.get('titulo'),
+        'autor': metadatos.get('autor'),
+        'num_paginas': metadatos.get('num_paginas'),
+        'productor': metadatos.get('productor'),
+        'asunto': metadatos.get('asunto'),
+        'creado': creado.replace(tzinfo=None) if isinstance(creado, datetime.datetime) else None,
+        'fecha_extraccion': datetime.datetime.utcnow()
+    }
+
+def guardar_metadatos_documento(documento, metadatos):
+    # Guarda en la base de datos los metadatos del PDF para no volver a abrirlo en cada listado
+    if not metadatos:
+        return None
+    registro = documento.metadatos or MetadatosDocumento(documento=documento)
+    for campo, valor in valores_metadatos(metadatos).items():
+        setattr(registro, campo, valor)
+    db.session.add(registro)
+    return registro
 
 def verificar_pdfs_registrados():
     pdf_dir = os.path.join(app.root_path, 'static', 'repositorio', 'documents')
@@ -453,143 +1964,443 @@ def verificar_pdfs_registrados():
     for nr in no_registrados:
         print(f" - {nr}")
 
+def reservar_numeros(nombre, cantidad, valor_inicial=lambda: 0):
+    # Reserva un bloque de números consecutivos del contador con un solo UPDATE atómico.
+    # Forma parte de la transacción en curso: si se revierte, el bloque no se consume.
+    sentencia = update(Contador).where(Contador.nombre == nombre).values(
+        valor=Contador.valor + cantidad
+    ).returning(Contador.valor).execution_options(synchronize_session=False)
+    fin = db.session.execute(sentencia).scalar()
+    if fin is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Contador(nombre=nombre, valor=valor_inicial()))
+        except IntegrityError:
+            pass  # otro proceso creó el contador al mismo tiempo
+        fin = db.session.execute(sentencia).scalar()
+    return range(fin - cantidad + 1, fin + 1)
+
+def _ultima_cedula_sintetica():
+    # Punto de partida del contador: la mayor cédula generada para autores creados automáticamente
+    cedulas = db.session.query(Profesor.cedula).filter(
+        Profesor.email.like('autor\\_%@umc.edu.ve', escape='\\'),
+        Profesor.cedula.like('V-%')
+    )
+    numeros = [int(cedula[2:]) for (cedula,) in cedulas if cedula[2:].isdigit()]
+    return max(numeros, default=0)
+
+def reservar_cedulas(cantidad):
+    # Cédulas sintéticas V-00000001, V-00000002... en tiempo constante, por bloques
+    cedulas = []
+    while len(cedulas) < cantidad:
+        faltan = cantidad - len(cedulas)
+        candidatas = [f"V-{str(numero).zfill(8)}" for numero in reservar_numeros('cedula_sintetica', faltan, _ultima_cedula_sintetica)]
+        # Descarta las que coincidan con una cédula real registrada
+        ocupadas = {cedula for (cedula,) in db.session.query(Profesor.cedula).filter(Profesor.cedula.in_(candidatas))}
+        cedulas.extend(c for c in candidatas if c not in ocupadas)
+    return cedulas
+
 def generar_cedula_unica():
-    numero = 1
-    while True:
-        cedula = f"V-{str(numero).zfill(8)}"
-        existe = Profesor.query.filter_by(cedula=cedula).first()
-        if not existe:
-            return cedula
-        numero += 1
+    return reservar_cedulas(1)[0]
+
+def autores_de_metadatos(metadatos):
+    # Extraer autores (pueden estar separados por coma o punto y coma)
+    if metadatos and metadatos.get('autor'):
+        autores = [a for a in separar_autores(metadatos['autor']) if normalizar_nombre(a)]
+        if autores:
+            return autores
+    return ['Autor Desconocido']
+
+def clasificar_pdf(nombre_archivo, metadatos):
+    # Deduce título, tipo, categoría, ISBN, palabras clave y fecha de un PDF importado
+    metadatos = metadatos or {}
+
+    # Tipo de documento automático
+    tipo_documento = 'articulo'
+    titulo_lower = metadatos['titulo'].lower() if metadatos.get('titulo') else ''
+    nombre_lower = nombre_archivo.lower()
+    if 'tesis' in titulo_lower or nombre_lower.startswith('tesis'):
+        tipo_documento = 'tesis'
+    elif 'libro' in titulo_lower or nombre_lower.startswith('libro'):
+        tipo_documento = 'libro'
+    elif 'manual' in titulo_lower or nombre_lower.startswith('manual'):
+        tipo_documento = 'manual'
+
+    # Categoría automática
+    categoria = 'General'
+    if metadatos.get('asunto'):
+        categoria = metadatos['asunto']
+    elif 'ingenieria' in nombre_lower:
+        categoria = 'Ingeniería Marítima'
+    elif 'navegacion' in nombre_lower:
+        categoria = 'Navegación'
+    elif 'seguridad' in nombre_lower:
+        categoria = 'Seguridad Marítima'
+
+    # Fecha de publicación
+    fecha_publicacion = None
+    creado = metadatos.get('creado')
+    if isinstance(creado, datetime.datetime):
+        fecha_publicacion = creado.date()
+    elif creado:
+        try:
+            # PyPDF2 suele devolver la fecha en formato 'D:YYYYMMDDHHmmSS'
+            fecha_raw = str(creado)
+            if fecha_raw.startswith('D:'):
+                fecha_raw = fecha_raw[2:]
+            fecha_publicacion = datetime.datetime.strptime(fecha_raw[:8], '%Y%m%d').date()
+        except Exception:
+            fecha_publicacion = None
 
-def registrar_pdfs_preexistentes():
-    pdf_dir = os.path.join(app.root_path, 'static', 'repositorio', 'documents')
-    archivos_pdf = [f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf')]
-    nuevos_registros = 0
+    return {
+        'titulo': metadatos.get('titulo') or nombre_archivo,
+        'tipo_documento': tipo_documento,
+        'categoria': categoria,
+        'isbn': metadatos.get('isbn') or None,
+        'palabras_clave': metadatos.get('palabras_clave') or None,
+        'fecha_publicacion': fecha_publicacion
+    }
 
-    for nombre_archivo in archivos_pdf:
-        existe = DocumentoRepositorio.query.filter_by(archivo_pdf=nombre_archivo).first()
-        if not existe:
-            metadatos = extraer_metadatos_pdf(nombre_archivo)
-            
-            # Extraer autores (pueden estar separados por coma o punto y coma)
-            autores = []
-            if metadatos and metadatos.get('autor'):
-                autores_raw = metadatos['autor']
-                if ';' in autores_raw:
-                    autores = [a.strip() for a in autores_raw.split(';')]
-                elif ',' in autores_raw:
-                    autores = [a.strip() for a in autores_raw.split(',')]
-                else:
-                    autores = [autores_raw.strip()]
+def _analizar_pdf_ingesta(ruta_pdf):
+    # Se ejecuta en los procesos de ingesta: devuelve solo tipos simples, fáciles de serializar
+    metadatos = _leer_metadatos_pdf(ruta_pdf)
+    if not metadatos:
+        return None
+    return {
+        clave: (str(valor) if isinstance(valor, str) else valor)
+        for clave, valor in metadatos.items()
+    }
+
+class ResolutorAutores:
+    """
+    Resuelve nombres de autores a profesores por nombre normalizado, con un mapa
+    cargado una sola vez, y crea en lote los autores que no existen
+    """
+    def __init__(self):
+        self.por_nombre = {}
+        filas = db.session.query(Profesor.id, Profesor.nombre_normalizado).order_by(Profesor.id).all()
+        for profesor_id, nombre_normalizado in filas:
+            if nombre_normalizado:
+                self.por_nombre.setdefault(nombre_normalizado, profesor_id)
+        self._password_hash = None
+
+    def resolver(self, nombres):
+        faltantes = {}
+        for autor_nombre in nombres:
+            clave = normalizar_nombre(autor_nombre)
+            if clave not in self.por_nombre:
+                faltantes.setdefault(clave, autor_nombre)
+
+        if faltantes:
+            # Todos los autores creados automáticamente comparten la misma contraseña temporal
+            if self._password_hash is None:
+                self._password_hash = cifrar_contrasena('temporal')
+            cedulas = reservar_cedulas(len(faltantes))
+            filas = [{
+                'cedula': cedula,
+                'nombre': autor_nombre,
+                'apellido': '',
+                'nombre_normalizado': clave,
+                'email': f"autor_{uuid.uuid4().hex}@umc.edu.ve",
+                'departamento': 'Desconocido',
+                'materias': '',
+                'password_hash': self._password_hash,
+                'activo': True,
+                'fecha_registro': datetime.datetime.utcnow()
+            } for (clave, autor_nombre), cedula in zip(faltantes.items(), cedulas)]
+            ids = db.session.execute(
+                insert(Profesor).returning(Profesor.id, sort_by_parameter_order=True), filas
+            ).scalars().all()
+            for clave, profesor_id in zip(faltantes, ids):
+                self.por_nombre[clave] = profesor_id
+        return {autor_nombre: self.por_nombre[normalizar_nombre(autor_nombre)] for autor_nombre in nombres}
+
+def _insertar_lote_pdfs(nombres_archivo, lista_metadatos, resolutor):
+    autores_por_pdf = [autores_de_metadatos(metadatos) for metadatos in lista_metadatos]
+    ids_autores = resolutor.resolver({nombre for autores in autores_por_pdf for nombre in autores})
+
+    ahora = datetime.datetime.utcnow()
+    filas = []
+    for nombre_archivo, metadatos, autores in zip(nombres_archivo, lista_metadatos, autores_por_pdf):
+        fila = clasificar_pdf(nombre_archivo, metadatos)
+        fila.update({
+            'descripcion': 'Documento importado automáticamente.',
+            'autor_id': ids_autores[autores[0]],  # Usa el primero como principal
+            'archivo_pdf': nombre_archivo,
+            'activo': True,
+            'descargas': 0,
+            'fecha_subida': ahora
+        })
+        filas.append(fila)
+    documento_ids = db.session.execute(
+        insert(DocumentoRepositorio).returning(DocumentoRepositorio.id, sort_by_parameter_order=True), filas
+    ).scalars().all()
+
+    filas_metadatos = [
+        dict(valores_metadatos(metadatos), documento_id=documento_id)
+        for documento_id, metadatos in zip(documento_ids, lista_metadatos) if metadatos
+    ]
+    if filas_metadatos:
+        db.session.execute(insert(MetadatosDocumento), filas_metadatos)
+
+    # La inserción en lote no dispara los eventos del modelo: indexar aquí
+    conexion = db.session.connection()
+    for documento_id, fila in zip(documento_ids, filas):
+        indexar_documento(conexion, documento_id, fila['titulo'], fila['descripcion'], fila['palabras_clave'])
+    return documento_ids
+
+def ingerir_pdfs(procesos=None, lote=500, informar=print):
+    pdf_dir = os.path.join(app.root_path, 'static', 'repositorio', 'documents')
+    registrados = {
+        nombre for (nombre,) in db.session.query(DocumentoRepositorio.archivo_pdf).filter(
+            DocumentoRepositorio.archivo_pdf.isnot(None)
+        )
+    }
+    nuevos = sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf') and f not in registrados)
+    if not nuevos:
+        return 0
+
+    procesos = procesos or os.cpu_count() or 1
+    resolutor = ResolutorAutores()
+    pool = ProcessPoolExecutor(max_workers=procesos) if procesos > 1 else None
+    # Los metadatos ya se guardan al insertar; el resto del procesamiento va a la cola como en una subida
+    tareas = [tipo for tipo in app.config['TAREAS_DOCUMENTO'] if tipo != 'metadatos_pdf']
+    total = 0
+    try:
+        for inicio in range(0, len(nuevos), lote):
+            bloque = nuevos[inicio:inicio + lote]
+            rutas = [os.path.join(pdf_dir, nombre) for nombre in bloque]
+            if pool:
+                lista_metadatos = list(pool.map(_analizar_pdf_ingesta, rutas, chunksize=8))
             else:
-                autores = ['Autor Desconocido']
-
-            # Registrar cada autor si no existe y usar el primero como autor principal
-            autor_ids = []
-            for autor_nombre in autores:
-                autor = Profesor.query.filter(
-                    db.or_(
-                        Profesor.nombre.ilike(f"%{autor_nombre}%"),
-                        Profesor.apellido.ilike(f"%{autor_nombre}%")
-                    )
-                ).first()
-                if not autor:
-                    cedula_generada = generar_cedula_unica()
-                    autor = Profesor(
-                        cedula=cedula_generada,
-                        nombre=autor_nombre,
-                        apellido='',
-                        email=f"autor_{uuid.uuid4().hex}@umc.edu.ve",
-                        departamento='Desconocido',
-                        materias='',
-                        password_hash=generate_password_hash('temporal'),
-                        activo=True
-                    )
-                    db.session.add(autor)
-                    db.session.flush()
-                autor_ids.append(autor.id)
-            autor_id = autor_ids[0] if autor_ids else 1  # Usa el primero como principal
-
-            # Tipo de documento automático
-            tipo_documento = 'articulo'
-            titulo_lower = (metadatos['titulo'].lower() if metadatos and metadatos.get('titulo') else '') 
-            nombre_lower = nombre_archivo.lower()
-            if 'tesis' in titulo_lower or nombre_lower.startswith('tesis'):
-                tipo_documento = 'tesis'
-            elif 'libro' in titulo_lower or nombre_lower.startswith('libro'):
-                tipo_documento = 'libro'
-            elif 'manual' in titulo_lower or nombre_lower.startswith('manual'):
-                tipo_documento = 'manual'
-
-            # Categoría automática
-            categoria = 'General'
-            asunto = metadatos.get('asunto') if metadatos else ''
-            if asunto:
-                categoria = asunto
-            elif 'ingenieria' in nombre_lower:
-                categoria = 'Ingeniería Marítima'
-            elif 'navegacion' in nombre_lower:
-                categoria = 'Navegación'
-            elif 'seguridad' in nombre_lower:
-                categoria = 'Seguridad Marítima'
-
-            # ISBN y palabras clave
-            isbn = metadatos.get('isbn') if metadatos and metadatos.get('isbn') else None
-            palabras_clave = None
-            if metadatos:
-                if metadatos.get('palabras_clave'):
-                    palabras_clave = metadatos['palabras_clave']
-                elif hasattr(metadatos, 'keywords') and metadatos.keywords:
-                    palabras_clave = metadatos.keywords
-
-            # Fecha de publicación
-            fecha_publicacion = None
-            if metadatos and metadatos.get('creado'):
-                try:
-                    # PyPDF2 suele devolver la fecha en formato 'D:YYYYMMDDHHmmSS'
-                    fecha_raw = str(metadatos['creado'])
-                    if fecha_raw.startswith('D:'):
-                        fecha_raw = fecha_raw[2:]
-                    fecha_publicacion = datetime.datetime.strptime(fecha_raw[:8], '%Y%m%d').date()
-                except Exception:
-                    fecha_publicacion = None
-
-            nuevo_doc = DocumentoRepositorio(
-                titulo=metadatos['titulo'] if metadatos and metadatos.get('titulo') else nombre_archivo,
-                descripcion='Documento importado automáticamente.',
-                autor_id=autor_id,
-                tipo_documento=tipo_documento,
-                categoria=categoria,
-                archivo_pdf=nombre_archivo,
-                activo=True,
-                fecha_subida=datetime.datetime.utcnow(),
-                isbn=isbn,
-                palabras_clave=palabras_clave,
-                fecha_publicacion=fecha_publicacion
-            )
-            db.session.add(nuevo_doc)
-            nuevos_registros += 1
+                lista_metadatos = [_analizar_pdf_ingesta(ruta) for ruta in rutas]
+            documento_ids = _insertar_lote_pdfs(bloque, lista_metadatos, resolutor)
+            for documento_id in documento_ids:
+                encolar_tareas(tareas, 'documento', documento_id)
+            db.session.commit()
+            total += len(documento_ids)
+            informar(f"{total}/{len(nuevos)} PDFs registrados")
+    finally:
+        if pool:
+            pool.shutdown()
+        invalidar_facetas()
+    return total
 
-    db.session.commit()
+def registrar_pdfs_preexistentes():
+    nuevos_registros = ingerir_pdfs(procesos=1, informar=lambda mensaje: None)
     print(f"Se registraron {nuevos_registros} nuevos documentos PDF.")
 
-@app.route('/zarpe')
-@app.route('/repositorio')
-def repositorio():
-    # Get filter parameters
-    categoria = request.args.get('categoria', '')
-    tipo = request.args.get('tipo', '')
-    buscar = request.args.get('buscar', '')
-    
-    # Query documents
+# Comandos de mantenimiento del repositorio: flask --app main repo <comando>
+repo_cli = AppGroup('repo', help='Mantenimiento del repositorio ZARPE.')
+app.cli.add_command(repo_cli)
+
+@repo_cli.command('ingest')
+@click.option('--procesos', type=int, default=None, help='Procesos para leer los PDF (por defecto, uno por CPU).')
+@click.option('--lote', type=int, default=500, show_default=True, help='Documentos insertados por transacción.')
+def ingest_comando(procesos, lote):
+    """Registra en lote los PDF de static/repositorio/documents que aún no están en la base de datos."""
+    total = ingerir_pdfs(procesos=procesos, lote=max(lote, 1))
+    print(f"Se registraron {total} nuevos documentos PDF.")
+
+def consolidar_descargas(conservar_dias=None):
+    # Recalcula desde los eventos los días completos aún no consolidados. Cada día se
+    # reemplaza entero, así que repetir la consolidación no duplica conteos.
+    ayer = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+    consolidacion = db.session.get(Consolidacion, 'descargas')
+    if consolidacion:
+        desde = consolidacion.ultimo_dia + datetime.timedelta(days=1)
+    else:
+        primera = db.session.query(func.min(EventoDescarga.fecha)).scalar()
+        if primera is None:
+            return 0
+        desde = primera.date()
+
+    dias = 0
+    if desde <= ayer:
+        inicio = datetime.datetime.combine(desde, datetime.time.min)
+        fin = datetime.datetime.combine(ayer + datetime.timedelta(days=1), datetime.time.min)
+        DescargaDiaria.query.filter(DescargaDiaria.fecha >= desde, DescargaDiaria.fecha <= ayer).delete()
+        db.session.execute(insert(DescargaDiaria).from_select(
+            ['documento_id', 'fecha', 'cantidad'],
+            select(
+                EventoDescarga.documento_id,
+                func.date(EventoDescarga.fecha),
+                func.count(EventoDescarga.id)
+            ).where(
+                EventoDescarga.fecha >= inicio,
+                EventoDescarga.fecha < fin
+            ).group_by(EventoDescarga.documento_id, func.date(EventoDescarga.fecha))
+        ))
+        # El registro se crea con el primer día consolidado: antes no hay nada que marcar
+        if consolidacion is None:
+            consolidacion = Consolidacion(nombre='descargas', ultimo_dia=ayer)
+            db.session.add(consolidacion)
+        consolidacion.ultimo_dia = ayer
+        dias = (ayer - desde).days + 1
+
+    if conservar_dias is not None:
+        # Solo se borran eventos de días ya consolidados
+        limite = min(datetime.datetime.utcnow().date() - datetime.timedelta(days=conservar_dias), ayer + datetime.timedelta(days=1))
+        EventoDescarga.query.filter(
+            EventoDescarga.fecha < datetime.datetime.combine(limite, datetime.time.min)
+        ).delete()
+    db.session.commit()
+    return dias
+
+def reporte_descargas(desde, hasta, documento_id=None):
+    query = db.session.query(DescargaDiaria.fecha, DescargaDiaria.documento_id, DescargaDiaria.cantidad).filter(
+        DescargaDiaria.fecha >= desde,
+        DescargaDiaria.fecha <= hasta
+    )
+    if documento_id:
+        query = query.filter(DescargaDiaria.documento_id == documento_id)
+    return query.order_by(DescargaDiaria.fecha, DescargaDiaria.documento_id).all()
+
+@repo_cli.command('consolidar-descargas')
+@click.option('--conservar-dias', type=int, default=None, help='Borra los eventos consolidados con más de N días.')
+def consolidar_descargas_comando(conservar_dias):
+    """Agrega los eventos de descarga en totales diarios por documento."""
+    print(f"Se consolidaron {consolidar_descargas(conservar_dias)} días de descargas.")
+
+@repo_cli.command('reporte-descargas')
+@click.option('--desde', type=click.DateTime(formats=['%Y-%m-%d']), required=True)
+@click.option('--hasta', type=click.DateTime(formats=['%Y-%m-%d']), required=True)
+@click.option('--documento', 'documento_id', type=int, default=None)
+def reporte_descargas_comando(desde, hasta, documento_id):
+    """Imprime en CSV las descargas diarias por documento (fecha,documento_id,cantidad)."""
+    print("fecha,documento_id,cantidad")
+    for fecha, doc_id, cantidad in reporte_descargas(desde.date(), hasta.date(), documento_id):
+        print(f"{fecha.isoformat()},{doc_id},{cantidad}")
+
+@repo_cli.command('reindexar-busqueda')
+def reindexar_busqueda_comando():
+    """Reconstruye el índice de texto completo del repositorio."""
+    if not busqueda_dialecto():
+        print("La búsqueda de texto completo no está disponible en esta base de datos.")
+        return
+    print(f"Se indexaron {reindexar_busqueda()} documentos.")
+
+@repo_cli.command('indexar-texto')
+@click.option('--todos', is_flag=True, help='Vuelve a extraer también los documentos ya indexados.')
+def indexar_texto_comando(todos):
+    """Extrae e indexa el texto de los PDF del repositorio."""
+    query = DocumentoRepositorio.query.filter(DocumentoRepositorio.archivo_pdf.isnot(None))
+    if not todos:
+        query = query.filter(~DocumentoRepositorio.fragmentos_texto.any())
+    documento_ids = [doc_id for (doc_id,) in query.with_entities(DocumentoRepositorio.id).all()]
+    total_fragmentos = 0
+    for documento_id in documento_ids:
+        total_fragmentos += indexar_texto_documento(documento_id)
+    print(f"Se indexaron {total_fragmentos} fragmentos de {len(documento_ids)} documentos.")
+
+@repo_cli.command('miniaturas')
+@click.option('--todas', is_flag=True, help='Vuelve a encolar también los documentos que ya tienen portada.')
+def miniaturas_comando(todas):
+    """Encola la generación de portadas de los PDF registrados."""
+    query = DocumentoRepositorio.query.filter(DocumentoRepositorio.archivo_pdf.isnot(None))
+    if not todas:
+        query = query.filter(db.or_(
+            DocumentoRepositorio.miniatura_sha256.is_(None),
+            DocumentoRepositorio.miniatura_sha256 != DocumentoRepositorio.sha256
+        ))
+    documento_ids = [doc_id for (doc_id,) in query.with_entities(DocumentoRepositorio.id).all()]
+    for documento_id in documento_ids:
+        encolar_tarea('miniatura_pdf', 'documento', documento_id)
+    db.session.commit()
+    print(f"Se encolaron {len(documento_ids)} portadas. Ejecuta `flask --app main tareas trabajar` para generarlas.")
+
+@repo_cli.command('calcular-hashes')
+def calcular_hashes_comando():
+    """Calcula el SHA-256 de los PDF y videos subidos antes de guardar el hash."""
+    actualizados = 0
+    for doc in DocumentoRepositorio.query.filter(
+        DocumentoRepositorio.archivo_pdf.isnot(None), DocumentoRepositorio.sha256.is_(None)
+    ):
+        if almacenamiento.existe(clave_documento(doc.archivo_pdf)):
+            doc.sha256 = calcular_sha256(clave_documento(doc.archivo_pdf))
+            actualizados += 1
+    for video in VideoClase.query.filter(VideoClase.archivo_video.isnot(None), VideoClase.sha256.is_(None)):
+        if almacenamiento.existe(video.archivo_video):
+            video.sha256 = calcular_sha256(video.archivo_video)
+            actualizados += 1
+    db.session.commit()
+    print(f"Se calcularon {actualizados} hashes.")
+
+@repo_cli.command('backfill-metadatos')
+def backfill_metadatos():
+    """Extrae y guarda los metadatos de los PDF registrados que aún no los tienen."""
+    documentos = DocumentoRepositorio.query.filter(
+        DocumentoRepositorio.archivo_pdf.isnot(None),
+        ~DocumentoRepositorio.metadatos.has()
+    ).all()
+    actualizados = 0
+    for doc in documentos:
+        if guardar_metadatos_documento(doc, extraer_metadatos_pdf(doc.archivo_pdf)):
+            actualizados += 1
+    db.session.commit()
+    print(f"Se guardaron metadatos de {actualizados} de {len(documentos)} documentos.")
+
+# Resumen de facetas del repositorio (conteos por categoría y tipo, descargas totales).
+# Se calcula con una sola consulta agrupada y se guarda en memoria hasta que un documento
+# cambia o vence el TTL, que acota la desactualización entre procesos de gunicorn.
+_cache_facetas = {'valor': None, 'expira': 0.0}
+_lock_facetas = threading.Lock()
+
+def calcular_facetas():
+    filas = db.session.query(
+        DocumentoRepositorio.categoria,
+        DocumentoRepositorio.tipo_documento,
+        func.count(DocumentoRepositorio.id),
+        func.coalesce(func.sum(DocumentoRepositorio.descargas), 0)
+    ).filter_by(activo=True).group_by(
+        DocumentoRepositorio.categoria,
+        DocumentoRepositorio.tipo_documento
+    ).all()
+    facetas = {'categorias': {}, 'tipos': {}, 'total_documentos': 0, 'total_descargas': 0}
+    for categoria, tipo, cantidad, descargas in filas:
+        facetas['categorias'][categoria] = facetas['categorias'].get(categoria, 0) + cantidad
+        facetas['tipos'][tipo] = facetas['tipos'].get(tipo, 0) + cantidad
+        facetas['total_documentos'] += cantidad
+        facetas['total_descargas'] += int(descargas)
+    return facetas
+
+def obtener_facetas():
+    ahora = time.monotonic()
+    with _lock_facetas:
+        if _cache_facetas['valor'] is not None and ahora < _cache_facetas['expira']:
+            return _cache_facetas['valor']
+    facetas = calcular_facetas()
+    with _lock_facetas:
+        _cache_facetas['valor'] = facetas
+        _cache_facetas['expira'] = ahora + app.config['FACETAS_TTL_SEGUNDOS']
+    return facetas
+
+def invalidar_facetas():
+    with _lock_facetas:
+        _cache_facetas['valor'] = None
+
+@event.listens_for(DocumentoRepositorio, 'after_insert')
+@event.listens_for(DocumentoRepositorio, 'after_update')
+@event.listens_for(DocumentoRepositorio, 'after_delete')
+def _invalidar_facetas_documento(mapper, connection, target):
+    invalidar_facetas()
+
+def opciones_listado_documentos():
+    # Relaciones que el listado usa por cada documento, cargadas en la misma consulta.
+    # Los metadatos del PDF se leen de la base de datos, nunca del archivo.
+    return (
+        db.joinedload(DocumentoRepositorio.metadatos),
+        db.joinedload(DocumentoRepositorio.autor),
+    )
+
+def filtrar_documentos(categoria, tipo, buscar):
     query = DocumentoRepositorio.query.filter_by(activo=True)
     
     if categoria:
         query = query.filter(DocumentoRepositorio.categoria == categoria)
     if tipo:
         query = query.filter(DocumentoRepositorio.tipo_documento == tipo)
-    if buscar:
+    if buscar and not busqueda_dialecto():
         query = query.filter(
             db.or_(
                 DocumentoRepositorio.titulo.contains(buscar),
@@ -597,23 +2408,136 @@ def repositorio():
                 DocumentoRepositorio.palabras_clave.contains(buscar)
             )
         )
-    
-    documentos = query.order_by(DocumentoRepositorio.fecha_subida.desc()).all()
+    return query
+
+def decodificar_cursor_busqueda(cursor):
+    # ['busqueda', desplazamiento]; cualquier otro valor vuelve al inicio del ranking
+    try:
+        valor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(valor, list) or len(valor) != 2 or valor[0] != 'busqueda':
+            return 0
+        return max(int(valor[1]), 0)
+    except (ValueError, TypeError):
+        return 0
+
+def buscar_documentos(query, buscar, cursor=None, por_pagina=None):
+    # Resultados ordenados por relevancia; el cursor guarda la posición dentro del ranking
+    por_pagina = min(max(por_pagina or app.config['REPOSITORIO_POR_PAGINA'], 1), app.config['REPOSITORIO_MAX_POR_PAGINA'])
+    desplazamiento = decodificar_cursor_busqueda(cursor) if cursor else 0
+    terminos = terminos_busqueda(buscar)
+    if not terminos:
+        return [], None, {}, 0
+
+    # Mejor coincidencia por documento, en sus campos o en el texto extraído del PDF
+    if busqueda_dialecto() == 'sqlite':
+        consulta = ' '.join(f'"{raiz_espanol(t)}"*' for t in terminos)
+        tabla_documentos = literal_column(TABLA_BUSQUEDA)
+        tabla_fragmentos = literal_column(TABLA_FRAGMENTOS)
+        indice_documentos = table(TABLA_BUSQUEDA, column('rowid'))
+        indice_fragmentos = table(TABLA_FRAGMENTOS, column('rowid'))
+        en_campos = select(
+            indice_documentos.c.rowid.label('documento_id'),
+            func.bm25(tabla_documentos, 10.0, 2.0, 5.0).label('rango'),
+            func.snippet(tabla_documentos, -1, MARCA_INICIO, MARCA_FIN, '…', 24).label('fragmento')
+        ).where(tabla_documentos.op('MATCH')(consulta))
+        en_contenido = select(
+            FragmentoTextoDocumento.documento_id,
+            (func.bm25(tabla_fragmentos) * PESO_CONTENIDO).label('rango'),
+            func.snippet(tabla_fragmentos, 0, MARCA_INICIO, MARCA_FIN, '…', 24).label('fragmento')
+        ).select_from(
+            indice_fragmentos.join(FragmentoTextoDocumento.__table__, indice_fragmentos.c.rowid == FragmentoTextoDocumento.id)
+        ).where(tabla_fragmentos.op('MATCH')(consulta))
+    else:
+        tsquery = func.websearch_to_tsquery('spanish', ' '.join(terminos))
+        opciones = f'StartSel={MARCA_INICIO}, StopSel={MARCA_FIN}, MaxFragments=2'
+        indice_documentos = table(TABLA_BUSQUEDA, column('documento_id'), column('vector'))
+        indice_fragmentos = table(TABLA_FRAGMENTOS, column('fragmento_id'), column('vector'))
+        en_campos = select(
+            indice_documentos.c.documento_id,
+            (-func.ts_rank_cd(indice_documentos.c.vector, tsquery)).label('rango'),
+            func.ts_headline(
+                'spanish',
+                func.concat_ws(' ', DocumentoRepositorio.titulo, DocumentoRepositorio.descripcion, DocumentoRepositorio.palabras_clave),
+                tsquery,
+                opciones
+            ).label('fragmento')
+        ).select_from(
+            indice_documentos.join(DocumentoRepositorio.__table__, indice_documentos.c.documento_id == DocumentoRepositorio.id)
+        ).where(indice_documentos.c.vector.op('@@')(tsquery))
+        en_contenido = select(
+            FragmentoTextoDocumento.documento_id,
+            (-func.ts_rank_cd(indice_fragmentos.c.vector, tsquery) * PESO_CONTENIDO).label('rango'),
+            func.ts_headline('spanish', FragmentoTextoDocumento.texto, tsquery, opciones).label('fragmento')
+        ).select_from(
+            indice_fragmentos.join(FragmentoTextoDocumento.__table__, indice_fragmentos.c.fragmento_id == FragmentoTextoDocumento.id)
+        ).where(indice_fragmentos.c.vector.op('@@')(tsquery))
+
+    coincidencias = union_all(en_campos, en_contenido).subquery()
+    numeradas = select(
+        coincidencias,
+        func.row_number().over(partition_by=coincidencias.c.documento_id, order_by=coincidencias.c.rango).label('posicion')
+    ).subquery()
+    mejores = select(numeradas.c.documento_id, numeradas.c.rango, numeradas.c.fragmento).where(
+        numeradas.c.posicion == 1
+    ).subquery()
+    query = query.join(mejores, mejores.c.documento_id == DocumentoRepositorio.id)
+    fragmento = mejores.c.fragmento
+    orden = mejores.c.rango.asc()
+
+    total = query.count()
+    filas = query.options(*opciones_listado_documentos()).add_columns(fragmento).order_by(
+        orden, DocumentoRepositorio.id.desc()
+    ).offset(desplazamiento).limit(por_pagina + 1).all()
+    siguiente = None
+    if len(filas) > por_pagina:
+        valor = json.dumps(['busqueda', desplazamiento + por_pagina])
+        siguiente = base64.urlsafe_b64encode(valor.encode('utf-8')).decode('ascii')
+    filas = filas[:por_pagina]
+    fragmentos = {doc.id: resaltar_fragmento(texto) for doc, texto in filas}
+    return [doc for doc, _ in filas], siguiente, fragmentos, total
+
+def codificar_cursor(documento):
+    valor = json.dumps([documento.fecha_subida.isoformat(), documento.id])
+    return base64.urlsafe_b64encode(valor.encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    try:
+        fecha, documento_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(fecha), int(documento_id)
+    except (ValueError, TypeError):
+        return None
+
+def paginar_documentos(query, cursor=None, por_pagina=None):
+    # Paginación por cursor sobre (fecha_subida, id): cada página es un rango indexado, sin OFFSET
+    por_pagina = min(max(por_pagina or app.config['REPOSITORIO_POR_PAGINA'], 1), app.config['REPOSITORIO_MAX_POR_PAGINA'])
+    posicion = decodificar_cursor(cursor) if cursor else None
+    if posicion:
+        fecha, documento_id = posicion
+        query = query.filter(
+            db.or_(
+                DocumentoRepositorio.fecha_subida < fecha,
+                db.and_(DocumentoRepositorio.fecha_subida == fecha, DocumentoRepositorio.id < documento_id)
+            )
+        )
+    query = query.options(*opciones_listado_documentos())
+    documentos = query.order_by(
+        DocumentoRepositorio.fecha_subida.desc(),
+        DocumentoRepositorio.id.desc()
+    ).limit(por_pagina + 1).all()
+    siguiente = codificar_cursor(documentos[por_pagina - 1]) if len(documentos) > por_pagina else None
+    return documentos[:por_pagina], siguiente
+
+def preparar_documentos(documentos, fragmentos=None):
+    fragmentos = fragmentos or {}
     documentos_con_metadatos = []
     for doc in documentos:
         metadatos = None
         autores = []
         if doc.archivo_pdf:
-            metadatos = extraer_metadatos_pdf(doc.archivo_pdf)
+            metadatos = doc.metadatos
             # Extraer autores del PDF
-            if metadatos and metadatos.get('autor'):
-                autores_raw = metadatos['autor']
-                if ';' in autores_raw:
-                    autores = [a.strip() for a in autores_raw.split(';')]
-                elif ',' in autores_raw:
-                    autores = [a.strip() for a in autores_raw.split(',')]
-                else:
-                    autores = [autores_raw.strip()]
+            if metadatos and metadatos.autor:
+                autores = separar_autores(metadatos.autor)
             else:
                 # Si no hay autores en metadatos, usa el autor de la base de datos
                 autores = [doc.autor.get_nombre_completo()]
@@ -622,20 +2546,99 @@ def repositorio():
         documentos_con_metadatos.append({
             'documento': doc,
             'metadatos': metadatos,
-            'autores': autores
+            'autores': autores,
+            'fragmento': fragmentos.get(doc.id)
         })
-    # Get categories and types for filters
-    categorias = db.session.query(DocumentoRepositorio.categoria).filter_by(activo=True).distinct().all()
-    tipos = db.session.query(DocumentoRepositorio.tipo_documento).filter_by(activo=True).distinct().all()
+    return documentos_con_metadatos
+
+def serializar_documento(item):
+    doc = item['documento']
+    metadatos = item['metadatos']
+    return {
+        'id': doc.id,
+        'titulo': doc.titulo,
+        'descripcion': doc.descripcion,
+        'tipo_documento': doc.tipo_documento,
+        'categoria': doc.categoria,
+        'palabras_clave': doc.palabras_clave,
+        'isbn': doc.isbn,
+        'fecha_publicacion': doc.fecha_publicacion.isoformat() if doc.fecha_publicacion else None,
+        'fecha_subida': doc.fecha_subida.isoformat() if doc.fecha_subida else None,
+        'descargas': doc.descargas or 0,
+        'autores': item['autores'],
+        'num_paginas': metadatos.num_paginas if metadatos else None,
+        'fragmento': str(item['fragmento']) if item['fragmento'] else None,
+        'url_descarga': url_descarga_documento(doc),
+        'miniaturas': {
+            ancho: url_for('miniatura_documento', sha256=doc.miniatura_sha256, ancho=ancho)
+            for ancho in app.config['MINIATURAS_ANCHOS']
+        } if doc.miniatura_sha256 else None
+    }
+
+@app.route('/zarpe')
+@app.route('/repositorio')
+def repositorio():
+    # Get filter parameters
+    categoria = request.args.get('categoria', '')
+    tipo = request.args.get('tipo', '')
+    buscar = request.args.get('buscar', '')
+    cursor = request.args.get('cursor', '')
+    por_pagina = request.args.get('por_pagina', type=int)
+    
+    # Categories, types and totals for filters
+    facetas = obtener_facetas()
+    
+    # Query documents
+    query = filtrar_documentos(categoria, tipo, buscar)
+    fragmentos = {}
+    if buscar and busqueda_dialecto():
+        documentos, siguiente_cursor, fragmentos, total_documentos = buscar_documentos(query, buscar, cursor, por_pagina)
+    else:
+        # Sin filtros el total ya está en las facetas
+        total_documentos = None if (categoria or tipo or buscar) else facetas['total_documentos']
+        if total_documentos is None:
+            total_documentos = query.count()
+        documentos, siguiente_cursor = paginar_documentos(query, cursor, por_pagina)
     
     return render_template('repositorio/zarpe.html', 
-                         documentos=documentos_con_metadatos,
-                         categorias=[c[0] for c in categorias],
-                         tipos=[t[0] for t in tipos],
+                         documentos=preparar_documentos(documentos, fragmentos),
+                         total_documentos=total_documentos,
+                         siguiente_cursor=siguiente_cursor,
+                         cursor_actual=cursor,
+                         facetas=facetas,
+                         categorias=sorted(facetas['categorias']),
+                         tipos=sorted(facetas['tipos']),
                          categoria_actual=categoria,
                          tipo_actual=tipo,
                          buscar_actual=buscar)
 
+@app.route('/api/repositorio/facetas')
+def api_repositorio_facetas():
+    return jsonify(obtener_facetas())
+
+# Background processing status, polled by the upload pages
+@app.route('/api/tareas/<any(documento, video):entidad>/<int:entidad_id>')
+@login_required
+def api_estado_tareas(entidad, entidad_id):
+    return jsonify(estado_tareas(entidad, entidad_id))
+
+# Repository listing API for infinite scroll
+@app.route('/api/repositorio/documentos')
+def api_repositorio_documentos():
+    buscar = request.args.get('buscar', '')
+    cursor = request.args.get('cursor', '')
+    por_pagina = request.args.get('por_pagina', type=int)
+    query = filtrar_documentos(request.args.get('categoria', ''), request.args.get('tipo', ''), buscar)
+    fragmentos = {}
+    if buscar and busqueda_dialecto():
+        documentos, siguiente_cursor, fragmentos, _ = buscar_documentos(query, buscar, cursor, por_pagina)
+    else:
+        documentos, siguiente_cursor = paginar_documentos(query, cursor, por_pagina)
+    return jsonify({
+        'documentos': [serializar_documento(item) for item in preparar_documentos(documentos, fragmentos)],
+        'siguiente': siguiente_cursor
+    })
+
 @app.route('/repositorio/subir', methods=['GET', 'POST'])
 @login_required
 def subir_documento():
@@ -661,16 +2664,14 @@ def subir_documento():
         
         # Handle file upload
         archivo_pdf = None
+        sha256 = None
         if 'archivo_pdf' in request.files:
             file = request.files['archivo_pdf']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                # Generate unique filename
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                archivo_pdf = unique_filename
+                # Content-addressed filename: <sha256>.pdf
+                archivo_pdf, sha256 = guardar_archivo_por_contenido(
+                    file, app.config['DOCUMENTOS_PREFIJO'], '.pdf', 'application/pdf'
+                )
         
         # Create new document
         nuevo_documento = DocumentoRepositorio()
@@ -682,6 +2683,7 @@ def subir_documento():
         nuevo_documento.palabras_clave = palabras_clave
         nuevo_documento.isbn = isbn
         nuevo_documento.archivo_pdf = archivo_pdf
+        nuevo_documento.sha256 = sha256
         nuevo_documento.url_externa = url_externa
         
         if fecha_publicacion:
@@ -691,13 +2693,244 @@ def subir_documento():
                 pass
         
         db.session.add(nuevo_documento)
+        if archivo_pdf:
+            # Metadatos, texto y antivirus se procesan en segundo plano
+            db.session.flush()
+            encolar_tareas(app.config['TAREAS_DOCUMENTO'], 'documento', nuevo_documento.id)
         db.session.commit()
         
         flash('Documento subido exitosamente al repositorio.', 'success')
+        if archivo_pdf:
+            return redirect(url_for('repositorio', procesando=nuevo_documento.id))
         return redirect(url_for('repositorio'))
     
     return render_template('repositorio/subir_documento.html')
 
+class BufferDescargas:
+    """
+    Acumula las descargas en memoria y las escribe en lote con UPDATE atómicos
+    """
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self._pendientes = Counter()
+        self._eventos = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def registrar(self, documento_id):
+        with self._lock:
+            self._pendientes[documento_id] += 1
+            self._eventos.append((documento_id, datetime.datetime.utcnow()))
+            # Un hilo por proceso, iniciado en el propio worker (después del fork de gunicorn)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._ciclo, name='buffer-descargas', daemon=True).start()
+
+    def _ciclo(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.vaciar()
+
+    def vaciar(self):
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, Counter()
+            eventos, self._eventos = self._eventos, []
+        if not pendientes:
+            return 0
+        try:
+            with app.app_context():
+                # descargas = descargas + n es atómico: los incrementos de cada worker se suman sin pisarse
+                with db.engine.begin() as conexion:
+                    conexion.execute(
+                        text("UPDATE documentos_repositorio SET descargas = COALESCE(descargas, 0) + :cantidad WHERE id = :id"),
+                        [{'id': documento_id, 'cantidad': cantidad} for documento_id, cantidad in pendientes.items()]
+                    )
+                    conexion.execute(
+                        insert(EventoDescarga.__table__),
+                        [{'documento_id': documento_id, 'fecha': fecha} for documento_id, fecha in eventos]
+                    )
+        except Exception as e:
+            # Devuelve los incrementos al buffer para el siguiente intento
+            with self._lock:
+                self._pendientes.update(pendientes)
+                self._eventos[:0] = eventos
+            logging.error(f"Error guardando descargas: {e}")
+            return 0
+        invalidar_facetas()
+        return sum(pendientes.values())
+
+buffer_descargas = BufferDescargas(app.config['DESCARGAS_INTERVALO_SEGUNDOS'])
+# Al cerrar el proceso (reinicio o apagado de gunicorn) se escriben las descargas pendientes
+atexit.register(buffer_descargas.vaciar)
+
+def enviar_pdf_repositorio(nombre_archivo, ruta, nombre_descarga=None, sha256=None, inmutable=False):
+    # Detrás de nginx, el propio nginx entrega el archivo desde una location interna
+    prefijo = app.config['REPOSITORIO_X_ACCEL_PREFIX']
+    if prefijo:
+        respuesta = Response(mimetype='application/pdf')
+        respuesta.headers['X-Accel-Redirect'] = prefijo.rstrip('/') + '/' + urllib.parse.quote(nombre_archivo)
+    else:
+        # send_file responde Range con 206, genera un ETag fuerte y atiende If-None-Match/If-Modified-Since;
+        # con USE_X_SENDFILE delega el envío al servidor web
+        respuesta = send_file(
+            ruta,
+            mimetype='application/pdf',
+            download_name=nombre_descarga or nombre_archivo,
+            conditional=True,
+            etag=sha256 or True
+        )
+        respuesta.headers['Accept-Ranges'] = 'bytes'
+    if inmutable:
+        # La URL lleva el hash del contenido: solo el navegador la guarda, nunca una caché compartida,
+        # para que un documento desactivado deje de entregarse
+        respuesta.headers['Cache-Control'] = f"private, max-age={app.config['REPOSITORIO_CACHE_SEGUNDOS']}, immutable"
+    else:
+        respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+def es_descarga_completa(respuesta):
+    # Cuenta la entrega del archivo: 200, o 206 desde el byte 0 (los visores de PDF piden por partes).
+    # Las respuestas 304 de la caché del navegador no son descargas nuevas.
+    if respuesta.status_code == 206:
+        return respuesta.content_range is not None and respuesta.content_range.start == 0
+    if respuesta.status_code == 200 and 'X-Accel-Redirect' in respuesta.headers:
+        # nginx atiende el Range: se mira la petición
+        rango = request.range
+        return rango is None or not rango.ranges or rango.ranges[0][0] == 0
+    return respuesta.status_code == 200
+
+@app.template_global()
+def url_descarga_documento(documento):
+    # La versión (hash del contenido) en la URL permite que el navegador guarde el PDF
+    return url_for('descargar_documento', documento_id=documento.id, v=(documento.sha256 or '')[:16] or None)
+
+# PDF first-page thumbnails: the URL contains the content hash, so it never changes meaning
+@app.route('/repositorio/miniaturas/<sha256>-<int:ancho>.webp')
+def miniatura_documento(sha256, ancho):
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256) or ancho not in app.config['MINIATURAS_ANCHOS']:
+        abort(404)
+    clave = clave_miniatura(sha256, ancho)
+    url_firmada = almacenamiento.url_descarga(clave, tipo='image/webp')
+    if url_firmada:
+        return redirect(url_firmada)
+    if not almacenamiento.existe(clave):
+        abort(404)
+    respuesta = send_file(
+        almacenamiento.ruta(clave),
+        mimetype='image/webp',
+        conditional=True,
+        etag=f'{sha256}-{ancho}',
+        max_age=app.config['MINIATURAS_CACHE_SEGUNDOS']
+    )
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+TIPOS_VIDEO = {'.mp4': 'video/mp4', '.m4v': 'video/mp4', '.mov': 'video/quicktime', '.webm': 'video/webm'}
+
+def _leer_rango(archivo, longitud):
+    try:
+        while longitud > 0:
+            bloque = archivo.read(min(app.config['BLOQUE_SUBIDA_BYTES'], longitud))
+            if not bloque:
+                break
+            longitud -= len(bloque)
+            yield bloque
+    finally:
+        archivo.close()
+
+def enviar_video(ruta, etag, clave=None, inmutable=False):
+    # Respuesta de video con Range (206/416), If-Range, ETag e If-None-Match. Las peticiones
+    # "bytes=N-" que hacen los navegadores al buscar se entregan con wsgi.file_wrapper desde el
+    # byte N, así gunicorn usa sendfile (copia cero) en lugar de leer el archivo en Python.
+    tamano = os.path.getsize(ruta)
+    tipo = TIPOS_VIDEO.get(os.path.splitext(ruta)[1].lower(), 'application/octet-stream')
+    cabeceras = {'Accept-Ranges': 'bytes', 'ETag': f'"{etag}"'}
+    if inmutable:
+        cabeceras['Cache-Control'] = f"public, max-age={app.config['VIDEOS_CACHE_SEGUNDOS']}, immutable"
+    else:
+        cabeceras['Cache-Control'] = 'public, no-cache'
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=cabeceras)
+
+    # Detrás de nginx, el propio nginx entrega el archivo (con sus rangos) desde una location interna
+    prefijo = app.config['STATIC_X_ACCEL_PREFIX']
+    if prefijo and clave:
+        cabeceras['X-Accel-Redirect'] = prefijo.rstrip('/') + '/' + urllib.parse.quote(clave)
+        return Response(mimetype=tipo, headers=cabeceras)
+
+    rango = request.range
+    if rango is not None and request.if_range.etag and request.if_range.etag != etag:
+        rango = None  # el archivo cambió desde que el cliente guardó la parte anterior
+    if rango is not None and rango.units == 'bytes' and len(rango.ranges) == 1:
+        limites = rango.range_for_length(tamano)
+        if limites is None:
+            cabeceras['Content-Range'] = f'bytes */{tamano}'
+            return Response(status=416, headers=cabeceras)
+        inicio, fin = limites
+        cabeceras['Content-Range'] = f'bytes {inicio}-{fin - 1}/{tamano}'
+        estado = 206
+    else:
+        inicio, fin = 0, tamano
+        estado = 200
+
+    archivo = open(ruta, 'rb')
+    archivo.seek(inicio)
+    if fin == tamano:
+        cuerpo = wrap_file(request.environ, archivo, app.config['BLOQUE_SUBIDA_BYTES'])
+    else:
+        cuerpo = _leer_rango(archivo, fin - inicio)
+    cabeceras['Content-Length'] = str(fin - inicio)
+    return Response(cuerpo, status=estado, mimetype=tipo, headers=cabeceras, direct_passthrough=True)
+
+@app.template_global()
+def url_video_clase(video):
+    # La versión (hash del contenido) en la URL permite cachear el video indefinidamente
+    return url_for('ver_video_clase', video_id=video.id, v=(video.sha256 or '')[:16] or None)
+
+@app.template_global()
+def url_hls_video(video):
+    # URL de la lista maestra guardada, que corresponde al contenido con el que se empaquetó
+    if not video.hls_playlist or not video.hls_playlist.startswith(app.config['HLS_PREFIJO']):
+        return None
+    sha256, _, archivo = video.hls_playlist[len(app.config['HLS_PREFIJO']):].partition('/')
+    return url_for('video_hls', sha256=sha256, archivo=archivo)
+
+def version_video_estatico(ruta):
+    stat = os.stat(ruta)
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+@app.template_global()
+def url_video_estatico(ruta):
+    try:
+        version = version_video_estatico(os.path.join(app.static_folder, ruta))
+    except OSError:
+        version = None
+    return url_for('ver_video_estatico', ruta=ruta, v=version)
+
+@app.route('/videos/clases/<int:video_id>')
+def ver_video_clase(video_id):
+    video = db.session.get(VideoClase, video_id)
+    if not video or not video.activo or not video.archivo_video:
+        abort(404)
+    etag = video.sha256 or hashlib.sha256(video.archivo_video.encode()).hexdigest()
+    inmutable = bool(video.sha256) and request.args.get('v') == video.sha256[:16]
+    url_firmada = almacenamiento.url_descarga(video.archivo_video, tipo=TIPOS_VIDEO.get(os.path.splitext(video.archivo_video)[1].lower()))
+    if url_firmada:
+        return redirect(url_firmada)
+    if not almacenamiento.existe(video.archivo_video):
+        abort(404)
+    return enviar_video(almacenamiento.ruta(video.archivo_video), etag, video.archivo_video, inmutable)
+
+@app.route('/videos/estaticos/<path:ruta>')
+def ver_video_estatico(ruta):
+    # Videos de las plantillas (p. ej. la guía del uniforme) con el mismo soporte de Range y caché
+    completa = safe_join(app.static_folder, ruta)
+    if not completa or os.path.splitext(ruta)[1].lower() not in TIPOS_VIDEO or not os.path.isfile(completa):
+        abort(404)
+    version = version_video_estatico(completa)
+    return enviar_video(completa, version, ruta, inmutable=request.args.get('v') == version)
+
 @app.route('/repositorio/descargar/<int:documento_id>')
 def descargar_documento(documento_id):
     documento = DocumentoRepositorio.query.get_or_404(documento_id)
@@ -706,21 +2939,28 @@ def descargar_documento(documento_id):
         flash('El documento no está disponible.', 'error')
         return redirect(url_for('repositorio'))
     
-    # Increment download counter
-    documento.descargas += 1
-    db.session.commit()
-    
     if documento.archivo_pdf:
-        # Ruta absoluta del archivo en el servidor
-        file_path = os.path.join(app.root_path, 'static', 'repositorio', 'documents', documento.archivo_pdf)
-        if os.path.exists(file_path):
-            # Si existe, redirige al archivo en static
-            return redirect(url_for('static', filename=f'repositorio/documents/{documento.archivo_pdf}'))
+        clave = clave_documento(documento.archivo_pdf)
+        nombre_descarga = f"{secure_filename(documento.titulo) or 'documento'}.pdf"
+        # Con almacenamiento S3 el navegador descarga directamente del bucket con una URL firmada
+        url_firmada = almacenamiento.url_descarga(clave, nombre_descarga, 'application/pdf')
+        if url_firmada:
+            buffer_descargas.registrar(documento.id)
+            return redirect(url_firmada)
+        if almacenamiento.existe(clave):
+            # Si existe en disco, se sirve directamente (con soporte de Range y GET condicional)
+            inmutable = bool(documento.sha256) and request.args.get('v') == documento.sha256[:16]
+            respuesta = enviar_pdf_repositorio(documento.archivo_pdf, almacenamiento.ruta(clave), nombre_descarga, documento.sha256, inmutable)
+            # Increment download counter (written to the database in batches)
+            if es_descarga_completa(respuesta):
+                buffer_descargas.registrar(documento.id)
+            return respuesta
         else:
             flash('El archivo PDF no existe en el repositorio.', 'error')
             return redirect(url_for('repositorio'))
     elif documento.url_externa:
         # Redirect to external URL
+        buffer_descargas.registrar(documento.id)
         return redirect(documento.url_externa)
     else:
         flash('El documento no tiene archivo disponible.', 'error')
@@ -748,8 +2988,11 @@ def login():
             user = Profesor.query.filter_by(email=email, activo=True).first()
         
         if user and user.password_hash and check_password_hash(user.password_hash, password):
+            if hash_desactualizado(user.password_hash):
+                # Aprovecha la contraseña en claro para llevar el hash a la política actual
+                user.password_hash = cifrar_contrasena(password)
+                db.session.commit()
             login_user(user)
-            user.user_type = user_type
             
             next_page = request.args.get('next')
             if user_type == 'profesor':
@@ -800,7 +3043,7 @@ def registro_estudiante():
         new_student.email = email
         new_student.telefono = telefono
         new_student.semestre = int(semestre) if semestre else 1
-        new_student.password_hash = generate_password_hash(password) if password else ''
+        new_student.password_hash = cifrar_contrasena(password) if password else ''
         
         db.session.add(new_student)
         db.session.commit()
@@ -849,7 +3092,7 @@ def registro_profesor():
         new_professor.materias = materias
         new_professor.experiencia_anos = int(experiencia_anos) if experiencia_anos else None
         new_professor.titulo_academico = titulo_academico
-        new_professor.password_hash = generate_password_hash(password) if password else ''
+        new_professor.password_hash = cifrar_contrasena(password) if password else ''
         
         db.session.add(new_professor)
         db.session.commit()
@@ -859,6 +3102,43 @@ def registro_profesor():
     
     return render_template('iniciar sesion/registro_profesor.html')
 
+# Consultas frecuentes del panel y de la evaluación docente, memorizadas por solicitud.
+# El usuario actual ya lo guarda Flask-Login en g durante la solicitud.
+@app.template_global()
+@memo_solicitud
+def token_qr_activo(profesor_id):
+    return TokenQRProfesor.query.filter_by(profesor_id=profesor_id, activo=True).first()
+
+@memo_solicitud
+def token_qr_por_valor(token):
+    return TokenQRProfesor.query.filter_by(token=token, activo=True).first()
+
+def obtener_token_qr(profesor_id):
+    qr_token = token_qr_activo(profesor_id)
+    if not qr_token:
+        # Generate new QR token
+        qr_token = TokenQRProfesor(profesor_id=profesor_id, token=str(uuid.uuid4()))
+        db.session.add(qr_token)
+        db.session.commit()
+        token_qr_activo.recordar(qr_token, profesor_id)
+    return qr_token
+
+CRITERIOS_EVALUACION = ('dominio_materia', 'claridad_explicacion', 'puntualidad',
+                        'disponibilidad', 'metodologia', 'evaluacion_general')
+
+@app.template_global()
+@memo_solicitud
+def resumen_evaluaciones(profesor_id):
+    # Total y promedio de cada criterio en una sola consulta agregada
+    fila = db.session.query(
+        func.count(EvaluacionDocente.id),
+        *[func.avg(getattr(EvaluacionDocente, criterio)) for criterio in CRITERIOS_EVALUACION]
+    ).filter(EvaluacionDocente.profesor_id == profesor_id).one()
+    promedios = {criterio: float(valor) if valor is not None else None
+                 for criterio, valor in zip(CRITERIOS_EVALUACION, fila[1:])}
+    general = sum(promedios.values()) / len(promedios) if fila[0] else None
+    return {'total': fila[0], 'promedios': promedios, 'general': general}
+
 @app.route('/panel-profesor')
 @login_required
 def panel_profesor():
@@ -867,20 +3147,7 @@ def panel_profesor():
         return redirect(url_for('index'))
     
     # Get professor's QR token
-    qr_token = TokenQRProfesor.query.filter_by(
-        profesor_id=current_user.id, 
-        activo=True
-    ).first()
-    
-    if not qr_token:
-        # Generate new QR token
-        token = str(uuid.uuid4())
-        qr_token = TokenQRProfesor(
-            profesor_id=current_user.id,
-            token=token
-        )
-        db.session.add(qr_token)
-        db.session.commit()
+    qr_token = obtener_token_qr(current_user.id)
     
     # Get professor's videos
     videos = VideoClase.query.filter_by(
@@ -918,13 +3185,16 @@ def subir_video():
         
         # Handle file upload
         archivo_video = None
+        sha256 = None
         if 'archivo_video' in request.files:
             file = request.files['archivo_video']
             if file and file.filename:
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(upload_dir, filename)
-                file.save(file_path)
-                archivo_video = f'uploads/{filename}'
+                # Content-addressed filename: <sha256>.<ext>
+                extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+                filename, sha256 = guardar_archivo_por_contenido(
+                    file, app.config['VIDEOS_PREFIJO'], extension, file.mimetype
+                )
+                archivo_video = app.config['VIDEOS_PREFIJO'] + filename
         
         new_video = VideoClase(
             profesor_id=current_user.id,
@@ -933,11 +3203,15 @@ def subir_video():
             materia=materia,
             semestre=int(semestre) if semestre else None,
             archivo_video=archivo_video,
+            sha256=sha256,
             url_video=url_video,
             duracion_minutos=int(duracion_minutos) if duracion_minutos else None
         )
         
         db.session.add(new_video)
+        if archivo_video:
+            db.session.flush()
+            encolar_tareas(app.config['TAREAS_VIDEO'], 'video', new_video.id)
         db.session.commit()
         
         flash('Video subido exitosamente.', 'success')
@@ -945,10 +3219,258 @@ def subir_video():
     
     return render_template('subir_video.html')
 
+# Subida por partes de videos grandes: el cliente crea una sesión, envía los bloques en
+# cualquier orden (reintentando los que fallen) y al final pide ensamblar el video. Cada
+# bloque se escribe en su posición dentro de un único archivo parcial, por lo que no hace
+# falta unirlos después y la memoria usada no depende del tamaño del video.
+def ruta_sesion_subida(sesion_id):
+    return os.path.join(app.config['SUBIDAS_DIRECTORIO'], f'{sesion_id}.parcial')
+
+def es_profesor_actual():
+    return hasattr(current_user, 'user_type') and current_user.user_type == 'profesor'
+
+def obtener_sesion_subida(sesion_id):
+    sesion = db.session.get(SesionSubida, sesion_id)
+    if sesion is None or sesion.profesor_id != current_user.id:
+        return None
+    return sesion
+
+def estado_sesion_subida(sesion):
+    recibidos = {indice for (indice,) in db.session.query(BloqueSubida.indice).filter_by(sesion_id=sesion.id)}
+    return {
+        'id': sesion.id,
+        'tamano': sesion.tamano,
+        'tamano_bloque': sesion.tamano_bloque,
+        'total_bloques': sesion.total_bloques,
+        'bloques_pendientes': [i for i in range(sesion.total_bloques) if i not in recibidos]
+    }
+
+def escribir_bloque_subida(sesion, indice, flujo, sha256_esperado=None):
+    # Copia el cuerpo de la petición en su posición del archivo parcial, por bloques y
+    # calculando el SHA-256. Devuelve un mensaje de error o None si el bloque quedó guardado.
+    inicio = indice * sesion.tamano_bloque
+    esperado = min(sesion.tamano_bloque, sesion.tamano - inicio)
+    # Desde aquí el rango del archivo cambia: el bloque queda pendiente hasta que se guarde completo
+    BloqueSubida.query.filter_by(sesion_id=sesion.id, indice=indice).delete()
+    db.session.commit()
+    sha = hashlib.sha256()
+    escritos = 0
+    with open(ruta_sesion_subida(sesion.id), 'r+b') as destino:
+        destino.seek(inicio)
+        while escritos <= esperado:
+            bloque = flujo.read(min(app.config['BLOQUE_SUBIDA_BYTES'], esperado + 1 - escritos))
+            if not bloque:
+                break
+            escritos += len(bloque)
+            if escritos > esperado:
+                break
+            sha.update(bloque)
+            destino.write(bloque)
+    if escritos != esperado:
+        return f'El bloque {indice} debe tener {esperado} bytes.'
+    digest = sha.hexdigest()
+    if sha256_esperado and sha256_esperado.lower() != digest:
+        return f'El bloque {indice} llegó dañado (SHA-256 distinto).'
+    db.session.merge(BloqueSubida(sesion_id=sesion.id, indice=indice, sha256=digest))
+    sesion.fecha_actualizacion = datetime.datetime.utcnow()
+    db.session.commit()
+    return None
+
+def eliminar_sesion_subida(sesion):
+    ruta = ruta_sesion_subida(sesion.id)
+    if os.path.exists(ruta):
+        os.remove(ruta)
+    db.session.delete(sesion)
+
+def limpiar_subidas_abandonadas(horas=None):
+    # Borra las sesiones sin actividad reciente y los archivos parciales que quedaron sin sesión
+    horas = app.config['SUBIDAS_RETENCION_HORAS'] if horas is None else horas
+    limite = datetime.datetime.utcnow() - datetime.timedelta(hours=horas)
+    sesiones = SesionSubida.query.filter(SesionSubida.fecha_actualizacion < limite).all()
+    for sesion in sesiones:
+        eliminar_sesion_subida(sesion)
+    db.session.commit()
+    directorio = app.config['SUBIDAS_DIRECTORIO']
+    limite_archivos = time.time() - horas * 3600
+    huerfanos = 0
+    if os.path.isdir(directorio):
+        activas = {sesion_id for (sesion_id,) in db.session.query(SesionSubida.id)}
+        for nombre in os.listdir(directorio):
+            ruta = os.path.join(directorio, nombre)
+            sesion_id = nombre.split('.')[0]
+            if sesion_id not in activas and os.path.getmtime(ruta) < limite_archivos:
+                os.remove(ruta)
+                huerfanos += 1
+    return len(sesiones), huerfanos
+
+@repo_cli.command('limpiar-subidas')
+@click.option('--horas', type=int, default=None, help='Horas sin actividad antes de borrar una subida (por defecto, SUBIDAS_RETENCION_HORAS).')
+def limpiar_subidas_comando(horas):
+    """Borra las subidas de video por partes abandonadas."""
+    sesiones, huerfanos = limpiar_subidas_abandonadas(horas)
+    print(f"Se borraron {sesiones} sesiones de subida y {huerfanos} archivos parciales sin sesión.")
+
+def campos_video_subida(datos):
+    # Datos del formulario al finalizar (JSON o form). Devuelve (campos del VideoClase, error)
+    if not isinstance(datos, dict):
+        return None, 'Se esperaba un objeto JSON o un formulario.'
+    campos = {}
+    for nombre in ('titulo', 'materia', 'descripcion'):
+        valor = datos.get(nombre)
+        if valor is not None and not isinstance(valor, str):
+            return None, f'{nombre} debe ser texto.'
+        campos[nombre] = valor or None
+    if not campos['titulo'] or not campos['materia']:
+        return None, 'Título y materia son obligatorios.'
+    for nombre in ('semestre', 'duracion_minutos'):
+        valor = datos.get(nombre)
+        if valor in (None, ''):
+            campos[nombre] = None
+            continue
+        if isinstance(valor, bool) or not isinstance(valor, (int, str)):
+            return None, f'{nombre} debe ser un número entero.'
+        try:
+            campos[nombre] = int(valor)
+        except ValueError:
+            return None, f'{nombre} debe ser un número entero.'
+    return campos, None
+
+@app.route('/api/videos/subidas', methods=['POST'])
+@login_required
+def iniciar_subida_video():
+    if not es_profesor_actual():
+        return jsonify({'error': 'Solo los profesores pueden subir videos.'}), 403
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict):
+        return jsonify({'error': 'Se esperaba un objeto JSON.'}), 400
+    nombre_archivo = datos.get('nombre_archivo')
+    nombre_archivo = secure_filename(nombre_archivo) if isinstance(nombre_archivo, str) else ''
+    tamano = datos.get('tamano')
+    if isinstance(tamano, bool) or not isinstance(tamano, int):
+        tamano = 0
+    if not nombre_archivo or tamano <= 0:
+        return jsonify({'error': 'Se requieren nombre_archivo y tamano.'}), 400
+    tipo, sha256 = datos.get('tipo'), datos.get('sha256')
+    if (tipo is not None and not isinstance(tipo, str)) or (
+            sha256 is not None and not (isinstance(sha256, str) and re.fullmatch(r'[0-9a-fA-F]{64}', sha256))):
+        return jsonify({'error': 'tipo debe ser texto y sha256 un hash hexadecimal de 64 caracteres.'}), 400
+    if tamano > app.config['VIDEO_MAX_BYTES']:
+        return jsonify({'error': 'El video supera el tamaño máximo permitido.'}), 413
+    sesion = SesionSubida(
+        profesor_id=current_user.id,
+        nombre_archivo=nombre_archivo,
+        tamano=tamano,
+        tamano_bloque=app.config['VIDEO_BLOQUE_BYTES'],
+        tipo_contenido=tipo or None,
+        sha256=sha256.lower() if sha256 else None
+    )
+    db.session.add(sesion)
+    db.session.flush()
+    # Archivo disperso del tamaño final: cada bloque se escribe directamente en su lugar
+    os.makedirs(app.config['SUBIDAS_DIRECTORIO'], exist_ok=True)
+    with open(ruta_sesion_subida(sesion.id), 'wb') as f:
+        f.truncate(tamano)
+    db.session.commit()
+    return jsonify(estado_sesion_subida(sesion)), 201
+
+@app.route('/api/videos/subidas/<sesion_id>')
+@login_required
+def estado_subida_video(sesion_id):
+    # Estudiantes y profesores comparten el rango de ids: la sesión no basta para identificar al dueño
+    if not es_profesor_actual():
+        return jsonify({'error': 'Solo los profesores pueden subir videos.'}), 403
+    sesion = obtener_sesion_subida(sesion_id)
+    if sesion is None:
+        return jsonify({'error': 'Sesión de subida no encontrada.'}), 404
+    return jsonify(estado_sesion_subida(sesion))
+
+@app.route('/api/videos/subidas/<sesion_id>/bloques/<int:indice>', methods=['PUT'])
+@login_required
+def subir_bloque_video(sesion_id, indice):
+    # Estudiantes y profesores comparten el rango de ids: la sesión no basta para identificar al dueño
+    if not es_profesor_actual():
+        return jsonify({'error': 'Solo los profesores pueden subir videos.'}), 403
+    sesion = obtener_sesion_subida(sesion_id)
+    if sesion is None:
+        return jsonify({'error': 'Sesión de subida no encontrada.'}), 404
+    if not 0 <= indice < sesion.total_bloques:
+        return jsonify({'error': 'Índice de bloque fuera de rango.'}), 400
+    error = escribir_bloque_subida(sesion, indice, request.stream, request.headers.get('X-Bloque-SHA256'))
+    if error:
+        return jsonify({'error': error}), 400
+    return '', 204
+
+@app.route('/api/videos/subidas/<sesion_id>/finalizar', methods=['POST'])
+@login_required
+def finalizar_subida_video(sesion_id):
+    # Estudiantes y profesores comparten el rango de ids: la sesión no basta para identificar al dueño
+    if not es_profesor_actual():
+        return jsonify({'error': 'Solo los profesores pueden subir videos.'}), 403
+    sesion = obtener_sesion_subida(sesion_id)
+    if sesion is None:
+        return jsonify({'error': 'Sesión de subida no encontrada.'}), 404
+    datos = request.get_json(silent=True) if request.is_json else request.form
+    campos, error = campos_video_subida(datos)
+    if error:
+        return jsonify({'error': error}), 400
+    estado = estado_sesion_subida(sesion)
+    if estado['bloques_pendientes']:
+        return jsonify(dict(estado, error='Faltan bloques por subir.')), 409
+
+    # Verificación final en una sola lectura: hash del archivo completo y de cada bloque,
+    # comparado con el que se registró al recibirlo
+    ruta = ruta_sesion_subida(sesion.id)
+    registrados = dict(db.session.query(BloqueSubida.indice, BloqueSubida.sha256).filter_by(sesion_id=sesion.id))
+    sha = hashlib.sha256()
+    corruptos = []
+    with open(ruta, 'rb') as f:
+        for indice in range(sesion.total_bloques):
+            sha_bloque = hashlib.sha256()
+            restante = sesion.tamano_bloque
+            while restante:
+                bloque = f.read(min(app.config['BLOQUE_SUBIDA_BYTES'], restante))
+                if not bloque:
+                    break
+                restante -= len(bloque)
+                sha.update(bloque)
+                sha_bloque.update(bloque)
+            if sha_bloque.hexdigest() != registrados.get(indice):
+                corruptos.append(indice)
+    digest = sha.hexdigest()
+    if corruptos:
+        # Se vuelven a pedir solo los bloques que no coinciden
+        BloqueSubida.query.filter(BloqueSubida.sesion_id == sesion.id, BloqueSubida.indice.in_(corruptos)).delete(synchronize_session=False)
+        db.session.commit()
+        return jsonify(dict(estado_sesion_subida(sesion), error='Hay bloques corruptos, vuelve a subirlos.')), 409
+    if os.path.getsize(ruta) != sesion.tamano or (sesion.sha256 and sesion.sha256 != digest):
+        return jsonify({'error': 'El archivo ensamblado no coincide con el declarado. Vuelve a subirlo.'}), 422
+
+    extension = os.path.splitext(sesion.nombre_archivo)[1].lower()
+    archivo_video = app.config['VIDEOS_PREFIJO'] + f"{digest}{extension}"
+    almacenamiento.guardar(archivo_video, ruta, sesion.tipo_contenido)
+    video = VideoClase(
+        profesor_id=current_user.id,
+        archivo_video=archivo_video,
+        sha256=digest,
+        **campos
+    )
+    db.session.add(video)
+    db.session.flush()
+    encolar_tareas(app.config['TAREAS_VIDEO'], 'video', video.id)
+    db.session.delete(sesion)
+    db.session.commit()
+    flash('Video subido exitosamente.', 'success')
+    return jsonify({
+        'id': video.id,
+        'archivo_video': archivo_video,
+        'estado_url': url_for('api_estado_tareas', entidad='video', entidad_id=video.id),
+        'redirigir': url_for('panel_profesor')
+    }), 201
+
 @app.route('/evaluar/<token>')
 def evaluar_docente_token(token):
     # Find professor by token
-    qr_token = TokenQRProfesor.query.filter_by(token=token, activo=True).first()
+    qr_token = token_qr_por_valor(token)
     if not qr_token:
         flash('Token de evaluación inválido o expirado.', 'error')
         return redirect(url_for('index'))
@@ -966,7 +3488,7 @@ def evaluar_docente_submit():
     token = request.form.get('token')
     
     # Find professor by token
-    qr_token = TokenQRProfesor.query.filter_by(token=token, activo=True).first()
+    qr_token = token_qr_por_valor(token)
     if not qr_token:
         flash('Token de evaluación inválido.', 'error')
         return redirect(url_for('index'))
@@ -1001,7 +3523,7 @@ def evaluar_docente_submit():
             apellido=' '.join(estudiante_nombre.split()[1:]) if len(estudiante_nombre.split()) > 1 else '',
             email=f"temp_{estudiante_cedula}@temp.umc.edu.ve",
             semestre=int(semestre),
-            password_hash=generate_password_hash('temp_password')
+            password_hash=cifrar_contrasena('temp_password')
         )
         db.session.add(estudiante)
         db.session.flush()  # Get the ID without committing
@@ -1037,23 +3559,118 @@ def evaluar_docente_submit():
     
     db.session.add(new_evaluation)
     db.session.commit()
+    resumen_evaluaciones.invalidar(qr_token.profesor_id)
     
     flash(f'¡Evaluación enviada exitosamente para {qr_token.profesor.get_nombre_completo()}! Gracias por tu retroalimentación.', 'success')
     return redirect(url_for('index'))
 
+# HLS playlists and segments. Packages are keyed by the video content hash, so every
+# file can be cached forever. Playlists are always served from here so that their
+# relative segment paths resolve against this URL, also with S3 storage.
+@app.route('/classroom/hls/<sha256>/<path:archivo>')
+def video_hls(sha256, archivo):
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256) or not re.fullmatch(r'(\d+p/)?[\w-]+\.(m3u8|ts)', archivo):
+        abort(404)
+    clave = f"{app.config['HLS_PREFIJO']}{sha256}/{archivo}"
+    tipo = TIPOS_HLS[os.path.splitext(archivo)[1]]
+    if archivo.endswith('.ts'):
+        url_firmada = almacenamiento.url_descarga(clave, tipo=tipo)
+        if url_firmada:
+            return redirect(url_firmada)
+    if not almacenamiento.existe(clave):
+        abort(404)
+    if isinstance(almacenamiento, AlmacenamientoLocal):
+        respuesta = send_file(almacenamiento.ruta(clave), mimetype=tipo, conditional=True, max_age=app.config['HLS_CACHE_SEGUNDOS'])
+    else:
+        with almacenamiento.abrir(clave) as f:
+            respuesta = Response(f.read(), mimetype=tipo)
+        respuesta.cache_control.max_age = app.config['HLS_CACHE_SEGUNDOS']
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+def filtros_catalogo_videos(semestre=None):
+    filtros = [VideoClase.activo.is_(True)]
+    if semestre:
+        # Los videos sin semestre están dirigidos a todos los semestres
+        filtros.append(db.or_(VideoClase.semestre == semestre, VideoClase.semestre.is_(None)))
+    return filtros
+
+def conteo_videos_por_materia(filtros):
+    # Agrupación y conteo en la base de datos, recorriendo ix_videos_clases_catalogo
+    return db.session.query(VideoClase.materia, func.count(VideoClase.id)).filter(*filtros).group_by(
+        VideoClase.materia
+    ).order_by(VideoClase.materia).all()
+
+def primeros_videos_por_materia(filtros, por_materia):
+    # Los N más recientes de cada materia en una sola consulta con row_number() por partición
+    fila = func.row_number().over(
+        partition_by=VideoClase.materia,
+        order_by=(VideoClase.fecha_subida.desc(), VideoClase.id.desc())
+    ).label('fila')
+    ranking = db.session.query(VideoClase.id.label('id'), fila).filter(*filtros).subquery()
+    videos = VideoClase.query.join(ranking, VideoClase.id == ranking.c.id).filter(
+        ranking.c.fila <= por_materia
+    ).options(db.joinedload(VideoClase.profesor)).order_by(
+        VideoClase.materia, VideoClase.fecha_subida.desc(), VideoClase.id.desc()
+    ).all()
+    por_grupo = {}
+    for video in videos:
+        por_grupo.setdefault(video.materia, []).append(video)
+    return por_grupo
+
+def paginar_videos(query, cursor=None, por_pagina=None):
+    # Mismo cursor por (fecha_subida, id) que el repositorio
+    por_pagina = max(por_pagina or app.config['CLASSROOM_POR_PAGINA'], 1)
+    posicion = decodificar_cursor(cursor) if cursor else None
+    if posicion:
+        fecha, video_id = posicion
+        query = query.filter(
+            db.or_(
+                VideoClase.fecha_subida < fecha,
+                db.and_(VideoClase.fecha_subida == fecha, VideoClase.id < video_id)
+            )
+        )
+    videos = query.options(db.joinedload(VideoClase.profesor)).order_by(
+        VideoClase.fecha_subida.desc(),
+        VideoClase.id.desc()
+    ).limit(por_pagina + 1).all()
+    siguiente = codificar_cursor(videos[por_pagina - 1]) if len(videos) > por_pagina else None
+    return videos[:por_pagina], siguiente
+
 @app.route('/classroom')
 def classroom():
-    # Get all videos from active professors
-    videos = VideoClase.query.filter_by(activo=True).order_by(VideoClase.fecha_subida.desc()).all()
-    
-    # Group videos by subject
-    videos_por_materia = {}
-    for video in videos:
-        if video.materia not in videos_por_materia:
-            videos_por_materia[video.materia] = []
-        videos_por_materia[video.materia].append(video)
-    
-    return render_template('recursos/classroom.html', videos_por_materia=videos_por_materia)
+    materia = request.args.get('materia', '').strip()
+    semestre = request.args.get('semestre', type=int)
+    cursor = request.args.get('cursor')
+
+    filtros = filtros_catalogo_videos(semestre)
+    conteos = conteo_videos_por_materia(filtros)
+
+    # Cada grupo: (materia, total, videos, cursor de la página siguiente o si hay más por ver)
+    grupos = []
+    if materia:
+        total = dict(conteos).get(materia, 0)
+        videos, siguiente = paginar_videos(
+            VideoClase.query.filter(*filtros, VideoClase.materia == materia), cursor
+        )
+        if total:
+            grupos.append((materia, total, videos, siguiente))
+    else:
+        por_materia = app.config['CLASSROOM_VIDEOS_POR_MATERIA']
+        primeros = primeros_videos_por_materia(filtros, por_materia)
+        for nombre, total in conteos:
+            videos = primeros.get(nombre, [])
+            grupos.append((nombre, total, videos, total > len(videos)))
+
+    return render_template(
+        'recursos/classroom.html',
+        grupos=grupos,
+        conteos=conteos,
+        materia=materia,
+        semestre=semestre,
+        con_cursor=bool(cursor)
+    )
 
 # Remove old docentes route since it's now private
 @app.route('/docentes')
@@ -3,4 +3,6 @@ import os
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    # Servidor de desarrollo: las tareas en segundo plano corren en un hilo del mismo proceso
+    app.config['TAREAS_TRABAJADOR_INTERNO'] = os.environ.get("TAREAS_TRABAJADOR_INTERNO", "1") == "1"
     app.run(host="0.0.0.0", port=port, debug=True)